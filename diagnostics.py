@@ -3,66 +3,977 @@
 Запуск диагностических тестов
 """
 import argparse
+import collections
+import concurrent.futures
+import contextlib
+import copy
 import datetime
+import errno
 import glob
+import hashlib
+import importlib
+import importlib.util
+import inspect
+import json
+import math
+import mmap
 import os
 import platform
-import cgn
-import app_manager
+import random
+import re
+import statistics
+import shlex
+import shutil
+import signal
+import socket
+import subprocess
+import sys
+import tempfile
+import threading
+import time
+import traceback
+import xml.etree.ElementTree as ET
+
+class LazyModule:
+    """
+    Модуль, импортируемый при первом обращении к его атрибуту.
+    Отсутствие модуля обнаруживается тоже при первом обращении
+    """
+    def __init__(self, name: str):
+        self._name = name
+        self._module = None
+
+    def __getattr__(self, attr: str):
+        if self._module is None:
+            self._module = importlib.import_module(self._name)
+        return getattr(self._module, attr)
+
+# Тяжелые зависимости загружаются только тестами, которые их используют
+redis = LazyModule('redis')
+cgn = LazyModule('cgn')
+app_manager = LazyModule('app_manager')
+PyCapture2 = LazyModule('PyCapture2')  # pylint: disable=invalid-name
+
+# Количество тестов, запускаемых одновременно
+DEFAULT_JOBS = 4
+
+# Подключение к redis: таймаут одной попытки, максимальная пауза между попытками и
+# общее время ожидания запуска redis. REDIS_SOCKET_TIMEOUT - таймаут одного запроса
+# (сервер принял подключение, но не отвечает)
+REDIS_CONNECT_TIMEOUT = 1.0
+REDIS_MAX_BACKOFF = 8.0
+REDIS_WAIT_TIMEOUT = 60.0
+REDIS_SOCKET_TIMEOUT = 10.0
+
+# Чтение db4.vehicle:model и db1.harvesters_dict:* за один запрос.
+# ARGV: номер базы с vehicle:model, номер базы с harvesters_dict, '1' - вернуть весь словарь
+VEHICLE_DICT_SCRIPT = """
+redis.call('SELECT', ARGV[1])
+local name = redis.call('GET', 'vehicle:model') or ''
+redis.call('SELECT', ARGV[2])
+local result = {name, redis.call('GET', 'harvesters_dict:' .. name) or ''}
+if ARGV[3] == '1' then
+    for _, key in ipairs(redis.call('KEYS', 'harvesters_dict:*')) do
+        table.insert(result, key)
+        table.insert(result, redis.call('GET', key) or '')
+    end
+end
+return result
+"""
+
+# Тест накопителя: размер временного файла, блоки последовательного и случайного доступа,
+# количество случайных операций и замеров fsync
+STORAGE_BENCH_SIZE = int(os.environ.get('STORAGE_BENCH_SIZE_MB', '64')) * 1048576
+STORAGE_SEQ_BLOCK = 1048576
+STORAGE_RANDOM_BLOCK = 4096
+STORAGE_RANDOM_OPS = 512
+STORAGE_FSYNC_OPS = 64
+# Пороги по модели платы (подстрока /proc/device-tree/model, '' - по умолчанию).
+# *_ms - максимальные значения, остальные - минимальные
+STORAGE_THRESHOLDS = {
+    '': {'seq_write_mbs': 20.0, 'seq_read_mbs': 40.0, 'rand_read_iops': 500.0,
+         'rand_write_iops': 100.0, 'fsync_p95_ms': 50.0},
+    'Jetson Nano': {'seq_write_mbs': 10.0, 'seq_read_mbs': 25.0, 'rand_read_iops': 300.0,
+                    'rand_write_iops': 50.0, 'fsync_p95_ms': 100.0},
+    'Jetson Xavier NX': {'seq_write_mbs': 40.0, 'seq_read_mbs': 80.0, 'rand_read_iops': 1500.0,
+                         'rand_write_iops': 300.0, 'fsync_p95_ms': 30.0},
+}
+
+# Профиль настройки ядра и сетевого интерфейса по модели платы (подстрока
+# /proc/device-tree/model, '' - для всех плат; совпавшие профили объединяются).
+# Ключи: параметры sysctl и ethtool.<интерфейс>.<ring|offload|coalesce>.<параметр>.
+# Значения: '>=N', '<=N' или точное значение
+SYSCTL_PROFILES = {
+    '': {
+        'net.core.rmem_max': '>=33554432',
+        'net.core.wmem_max': '>=33554432',
+        'net.core.rmem_default': '>=33554432',
+        'net.core.wmem_default': '>=33554432',
+        'net.core.netdev_max_backlog': '>=1000',
+    },
+    'Jetson': {
+        'ethtool.eth0.offload.rx-checksumming': 'on',
+        'ethtool.eth0.offload.tx-checksumming': 'on',
+        'ethtool.eth0.offload.generic-receive-offload': 'on',
+    },
+}
+
+# Фоновый сбор загрузки CPU/GPU, памяти и температуры во время тестов: период, с
+# (0 - отключить), и максимальное количество хранимых замеров
+RESOURCE_SAMPLE_INTERVAL = float(os.environ.get('DIAGNOSTICS_SAMPLE_INTERVAL', '0.5'))
+RESOURCE_SAMPLES_MAX = 7200
+# Файлы загрузки GPU Jetson (промилле)
+GPU_LOAD_PATHS = ['/sys/devices/gpu.0/load', '/sys/devices/platform/gpu.0/load',
+                  '/sys/devices/*.gpu/load']
+
+# Количество последних строк вывода процесса, сохраняемых для сообщений об ошибках
+STREAM_TAIL_LINES = 50
+
+# Таймауты проверок docker compose config и пробных запусков dir_cleaner/dir_monitor, с
+COMPOSE_CONFIG_TIMEOUT = 60
+SERVICE_DRY_RUN_TIMEOUT = 180
+
+# Время жизни индекса проверки владельцев файлов, после которого выполняется полная проверка
+FILES_OWNER_INDEX_TTL = 24 * 3600
+
+# Проверка контрольных сумм моделей (sha256sum-формат, пути относительно корня версии).
+# DIAGNOSTICS_MODEL_INTEGRITY=0 - проверять только наличие файлов моделей
+MODELS_MANIFEST = os.path.join('info', 'models.sha256')
+MODEL_INTEGRITY = os.environ.get('DIAGNOSTICS_MODEL_INTEGRITY', '1') == '1'
+MODEL_HASH_CHUNK = 16 * 1048576
+MODEL_HASH_JOBS = min(os.cpu_count() or 1, 4)
+
+# Тест скорости канала до 192.168.10.10 (iperf3). Пороги переопределяются переменными
+# окружения: IPERF_MAX_RETRANSMITS не задан - ретрансляции не проверяются,
+# IPERF_UDP_BITRATE (например, 100M) - дополнительно измеряются jitter и потери по UDP
+IPERF_SERVER_IP = '192.168.10.10'
+IPERF_PORT = 5201
+IPERF_SERVER_TIMEOUT = 10
+IPERF_DURATION = int(os.environ.get('IPERF_DURATION', '10'))
+IPERF_MIN_MBITS = float(os.environ.get('IPERF_MIN_MBITS', '80'))
+IPERF_MAX_RETRANSMITS = os.environ.get('IPERF_MAX_RETRANSMITS')
+IPERF_UDP_BITRATE = os.environ.get('IPERF_UDP_BITRATE')
+IPERF_MAX_JITTER_MS = float(os.environ.get('IPERF_MAX_JITTER_MS', '1.0'))
+IPERF_MAX_LOST_PERCENT = float(os.environ.get('IPERF_MAX_LOST_PERCENT', '1.0'))
+
+# Количество хранимых результатов в истории измерений
+BENCHMARK_HISTORY_SIZE = 100
+
+# Максимальное время работы FlyCapture2Test, с
+FLYCAP_TEST_TIMEOUT = 20
+
+# Проверка потока кадров камер: время сбора кадров, с, и пороги для каждой камеры.
+# CAMERA_FRAME_SOURCE - источник кадров без камер: json-файл {серийный номер: [время кадра, с]}
+# или 'simulate:<серийный номер>=<fps>[,...]'
+CAMERA_SAMPLE_TIME = float(os.environ.get('CAMERA_SAMPLE_TIME', '5'))
+CAMERA_MIN_FPS = float(os.environ.get('CAMERA_MIN_FPS', '15'))
+CAMERA_MAX_DROPPED_PERCENT = float(os.environ.get('CAMERA_MAX_DROPPED_PERCENT', '1'))
+CAMERA_MAX_JITTER_MS = float(os.environ.get('CAMERA_MAX_JITTER_MS', '10'))
+
+# Проверка DBW: количество опросов за один запуск контейнера, максимальное время
+# одного опроса, с, и необязательный порог p95 задержки, мс
+DBW_PROBE_COUNT = int(os.environ.get('DBW_PROBE_COUNT', '5'))
+DBW_PROBE_TIMEOUT = 30
+DBW_MAX_P95_MS = os.environ.get('DBW_MAX_P95_MS')
+
+# Нейросетевые стенды: максимальное время работы, с, размер скользящей базы (результаты
+# той же версии образа и модели платы), минимальное количество результатов в базе и
+# допустимое снижение FPS относительно медианы базы
+OFFLINE_STAND_TIMEOUT = 1800
+OFFLINE_STAND_BASELINE_SIZE = 10
+OFFLINE_STAND_BASELINE_MIN = 3
+OFFLINE_STAND_MAX_REGRESSION = float(os.environ.get('OFFLINE_STAND_MAX_REGRESSION', '0.15'))
+# Итоговые строки вывода start_offline_stand.py с FPS ("FPS: 12.5", "avg fps = 12.5") и
+# временем обработки кадра ("frame time: 80.1 ms"). Шаблоны привязаны ко всей строке,
+# чтобы не совпадать с выводом аргументов (--min-fps=2, min_fps=2); переопределяются
+# через OFFLINE_STAND_FPS_PATTERN и OFFLINE_STAND_FRAME_TIME_PATTERN
+OFFLINE_STAND_FPS_RE = re.compile(os.environ.get(
+    'OFFLINE_STAND_FPS_PATTERN',
+    r'^\s*(?:avg|average|mean)?\s*fps\s*[:=]\s*(\d+(?:\.\d+)?)\s*$'), re.IGNORECASE)
+OFFLINE_STAND_FRAME_TIME_RE = re.compile(os.environ.get(
+    'OFFLINE_STAND_FRAME_TIME_PATTERN',
+    r'^\s*frame(?:\s+time)?\s*[:=]\s*(\d+(?:\.\d+)?)\s*ms\s*$'), re.IGNORECASE)
+
+# Бюджет времени запуска, с: импорт модуля, сбор тестов pytest и запуск одной простой
+# проверки (--startup-benchmark). Значение - медиана STARTUP_BENCHMARK_REPEAT запусков
+STARTUP_BUDGET = {'import': 0.5, 'collect': 2.0, 'run': 3.0}
+STARTUP_BENCHMARK_REPEAT = 5
+STARTUP_BENCHMARK_PATTERN = 'ip_for_main_connection'
+
+# Сколько тестов с ресурсом может выполняться одновременно (по умолчанию 1).
+# DIAGNOSTICS_GPU_SLOTS - сколько нейросетевых тестов помещается на GPU одновременно.
+# Стенды start_offline_stand.py запускают контейнеры и поэтому используют еще и docker:
+# друг с другом и с тестами контейнеров они выполняются по очереди
+RESOURCE_CAPACITY = {
+    'gpu': int(os.environ.get('DIAGNOSTICS_GPU_SLOTS', '1')),
+}
+
+# Ресурсы, которые использует тест. Тесты с общим ресурсом не запускаются одновременно:
+# docker - создание/удаление контейнеров, redis - база данных, network - канал до
+# 192.168.10.10, camera - камера flycap, serial - порт DBW, gpu - нейросетевые стенды.
+# dir_cleaner и dir_monitor без запущенного контейнера сервиса создают временный
+# контейнер (autostart.sh/stop_containers.sh), поэтому тоже используют docker
+TEST_RESOURCES = {
+    'test_all_redis_connection': ['redis'],
+    'test_all_vehicle_dict': ['redis'],
+    'test_all_harvesters_dict': ['redis'],
+    'test_aarch64_eth_speed': ['network'],
+    'test_all_docker_container': ['docker'],
+    'test_all_interactive_start': ['docker'],
+    'test_all_yaml': ['docker'],
+    'test_all_dir_cleaner': ['docker'],
+    'test_all_dir_monitor': ['docker'],
+    'test_all_flycap_test': ['camera'],
+    'test_all_camera_fps': ['camera'],
+    'test_aarch64_dbw_box': ['docker', 'serial'],
+    'test_offline_stand_kromka': ['docker', 'gpu'],
+    'test_offline_stand_valok': ['docker', 'gpu'],
+    'test_offline_stand_corn_rows': ['docker', 'gpu'],
+    'test_all_culture_model_mapping': ['disk'],
+    'test_all_storage_benchmark': ['disk'],
+}
+
+class DiagnosticsContext:
+    """
+    Параметры запуска диагностики, вычисляемые один раз при первом обращении
+    """
+    def __init__(self, script_file: str):
+        self._script_file = script_file
+        self._values = dict()
+        self._lock = threading.RLock()
+
+    def _get(self, key: str, func):
+        with self._lock:
+            if key not in self._values:
+                self._values[key] = func()
+            return self._values[key]
+
+    def invalidate(self, key: str = None):
+        """
+        Сброс закэшированных значений (всех или одного)
+        """
+        with self._lock:
+            if key is None:
+                self._values.clear()
+            else:
+                self._values.pop(key, None)
+
+    @property
+    def script_dir(self):
+        """
+        Директория со скриптами
+        """
+        return self._get(
+            'script_dir', lambda: os.path.dirname(os.path.abspath(self._script_file)))
+
+    @property
+    def minimal_version_dir(self):
+        """
+        Корневая директория версии
+        """
+        return self._get(
+            'minimal_version_dir', lambda: os.path.abspath(os.path.join(self.script_dir, '..')))
+
+    @property
+    def app_dir(self):
+        """
+        Директория приложения
+        """
+        return self._get('app_dir', get_app_dir)
+
+    @property
+    def version(self):
+        """
+        Содержимое info/version.txt
+        """
+        return self._get('version', lambda: cgn.utils.read_str_from_file(
+            os.path.join(self.script_dir, '..', 'info', 'version.txt')))
+
+    @property
+    def major_image_version(self):
+        """
+        Номер версии образа (число после -v)
+        """
+        return self._get('major_image_version', lambda: int(
+            self.version[self.version.find('-v')+2:]))
+
+    @property
+    def arch(self):
+        """
+        Архитектура платформы
+        """
+        return self._get('arch', platform.machine)
+
+    @property
+    def compose_config(self):
+        """
+        Путь к docker-compose конфигурации по умолчанию
+        """
+        return self._get('compose_config', app_manager.get_default_config)
+
+    @property
+    def compose_data(self):
+        """
+        Разобранная docker-compose конфигурация. Изменять только копию (copy.deepcopy)
+        """
+        return self._get('compose_data', lambda: cgn.utils.load_yaml(self.compose_config))
+
+    @property
+    def board_model(self):
+        """
+        Модель платы из /proc/device-tree/model, пустая строка если недоступна
+        """
+        return self._get('board_model', read_board_model)
+
+def read_board_model():
+    """
+    read_board_model
+    """
+    return read_str_from_file_safe('/proc/device-tree/model').strip('\0\n')
+
+DIAGNOSTICS_CONTEXT = DiagnosticsContext(__file__)
+
+def get_diagnostics_context():
+    """
+    Возвращает общий для всего запуска DiagnosticsContext
+    """
+    return DIAGNOSTICS_CONTEXT
+
+def read_cpu_times():
+    """
+    (время простоя, общее время) CPU из /proc/stat
+    """
+    values = [int(value) for value in read_str_from_file_safe('/proc/stat').split(
+        '\n', 1)[0].split()[1:]]
+    return sum(values[3:5]), sum(values)
+
+def read_meminfo():
+    """
+    /proc/meminfo: {параметр: значение в кБ}
+    """
+    meminfo = dict()
+    for line in read_str_from_file_safe('/proc/meminfo').split('\n'):
+        name, _, value = line.partition(':')
+        if value.split():
+            meminfo[name] = int(value.split()[0])
+    return meminfo
+
+class ResourceSampler:
+    """
+    Фоновый поток, раз в RESOURCE_SAMPLE_INTERVAL секунд сохраняющий загрузку CPU/GPU,
+    памяти и максимальную температуру. Один поток на все параллельные тесты: статистика
+    теста считается по замерам за время его работы
+    """
+    def __init__(self, interval: float):
+        self._interval = interval
+        self._lock = threading.Lock()
+        self._samples = collections.deque(maxlen=RESOURCE_SAMPLES_MAX)
+        self._users = 0
+        self._stop_event = None
+        self._cpu_times = None
+        self._thermal_paths = None
+        self._gpu_path = None
+
+    def sample(self):
+        """
+        Один замер: {параметр: значение}
+        """
+        values = dict()
+        cpu_times = read_cpu_times()
+        if self._cpu_times is not None and cpu_times[1] > self._cpu_times[1]:
+            values['cpu_percent'] = 100.0 * (1.0 - float(cpu_times[0] - self._cpu_times[0]) /
+                                             (cpu_times[1] - self._cpu_times[1]))
+        self._cpu_times = cpu_times
+        meminfo = read_meminfo()
+        if meminfo.get('MemTotal') and 'MemAvailable' in meminfo:
+            values['mem_used_percent'] = 100.0 * (
+                1.0 - float(meminfo['MemAvailable']) / meminfo['MemTotal'])
+        temperatures = [int(value) / 1000.0 for value in [
+            read_str_from_file_safe(path).strip() for path in self._thermal_paths]
+                        if value.lstrip('-').isdigit()]
+        if temperatures:
+            values['temp_c'] = max(temperatures)
+        if self._gpu_path is not None:
+            load = read_str_from_file_safe(self._gpu_path).strip()
+            if load.isdigit():
+                values['gpu_percent'] = int(load) / 10.0
+        return values
+
+    def _run(self, stop_event):
+        while True:
+            values = self.sample()
+            with self._lock:
+                self._samples.append((time.monotonic(), values))
+            if stop_event.wait(self._interval):
+                return
+
+    def start(self):
+        """
+        Начало теста, возвращает время начала. Поток запускается первым тестом
+        """
+        with self._lock:
+            self._users += 1
+            if self._users == 1:
+                if self._thermal_paths is None:
+                    self._thermal_paths = sorted(
+                        glob.glob('/sys/class/thermal/thermal_zone*/temp'))
+                    self._gpu_path = next((path for pattern in GPU_LOAD_PATHS
+                                           for path in sorted(glob.glob(pattern))), None)
+                self._stop_event = threading.Event()
+                threading.Thread(target=self._run, args=(self._stop_event,), daemon=True).start()
+        return time.monotonic()
+
+    def stop(self, start: float):
+        """
+        Окончание теста: {параметр: {'min', 'avg', 'max'}} за время с start.
+        Поток останавливается после окончания последнего теста
+        """
+        with self._lock:
+            self._users -= 1
+            if self._users == 0:
+                self._stop_event.set()
+            samples = [values for stamp, values in self._samples if stamp >= start]
+            if len(samples) == 0 and len(self._samples) > 0:
+                samples = [self._samples[-1][1]]
+        summary = dict()
+        for key in sorted(set(key for values in samples for key in values)):
+            series = [values[key] for values in samples if key in values]
+            summary[key] = {'min': round(min(series), 1),
+                            'avg': round(statistics.mean(series), 1),
+                            'max': round(max(series), 1)}
+        return summary
+
+RESOURCE_SAMPLER = ResourceSampler(RESOURCE_SAMPLE_INTERVAL)
+
+PROFILE = threading.local()
+REPORT_RESULTS = []
+
+def start_profile(name: str):
+    """
+    Начало сбора статистики теста в текущем потоке
+    """
+    PROFILE.current = {
+        'name': name, 'subprocess_count': 0, 'subprocess_time': 0.0,
+        'subprocesses': [], 'metrics': dict(), 'resources': dict()}
+    PROFILE.sampler_start = RESOURCE_SAMPLER.start() if RESOURCE_SAMPLE_INTERVAL > 0 else None
+    return PROFILE.current
+
+def stop_profile():
+    """
+    Завершение сбора статистики теста в текущем потоке
+    """
+    profile = getattr(PROFILE, 'current', None)
+    PROFILE.current = None
+    if profile is not None and getattr(PROFILE, 'sampler_start', None) is not None:
+        profile['resources'] = RESOURCE_SAMPLER.stop(PROFILE.sampler_start)
+        PROFILE.sampler_start = None
+    return profile
+
+def make_empty_result(name: str, status: str, reason: str, duration: float = 0.0):
+    """
+    Результат теста без собранной статистики (тест не запускался)
+    """
+    return {'name': name, 'status': status, 'reason': reason, 'duration': duration,
+            'subprocess_count': 0, 'subprocess_time': 0.0, 'subprocesses': [],
+            'metrics': dict(), 'resources': dict()}
+
+def record_metric(name: str, value):
+    """
+    Сохранение измеренного значения в отчет текущего теста
+    """
+    profile = getattr(PROFILE, 'current', None)
+    if profile is not None:
+        profile['metrics'][name] = value
+
+def profile_subprocess(func, cmd: str, **kwargs):
+    """
+    Вызов функции cgn.utils.run_subprocess* с учетом в статистике текущего теста
+    """
+    start = time.monotonic()
+    status = 'ok'
+    try:
+        return func(cmd, **kwargs)
+    except BaseException as exc:
+        status = type(exc).__name__
+        raise
+    finally:
+        record_subprocess(cmd, time.monotonic() - start, status)
+
+def record_subprocess(cmd: str, duration: float, status: str):
+    """
+    Учет запуска процесса в статистике текущего теста
+    """
+    profile = getattr(PROFILE, 'current', None)
+    if profile is not None:
+        profile['subprocess_count'] += 1
+        profile['subprocess_time'] += duration
+        profile['subprocesses'].append({'cmd': cmd, 'duration': duration, 'status': status})
+
+def stop_process_group(proc):
+    """
+    Завершение процесса вместе с дочерними (SIGTERM, затем SIGKILL)
+    """
+    for sig in [signal.SIGTERM, signal.SIGKILL]:
+        try:
+            os.killpg(proc.pid, sig)
+        except ProcessLookupError:
+            return
+        try:
+            proc.wait(timeout=2)
+            return
+        except subprocess.TimeoutExpired:
+            pass
+
+def iter_subprocess_lines(cmd: str, timeout: float = None, info: dict = None):
+    """
+    Построчное чтение вывода процесса (stdout и stderr) во время его работы.
+    Если чтение прекращено раньше (закрытие генератора) или истек таймаут,
+    процесс завершается. Использовать с contextlib.closing.
+    В info (если передан) сохраняются status и returncode
+    """
+    start = time.monotonic()
+    status = 'ok'
+    proc = subprocess.Popen(
+        cmd, shell=True, stdin=subprocess.DEVNULL, stdout=subprocess.PIPE,
+        stderr=subprocess.STDOUT, universal_newlines=True, errors='replace',
+        start_new_session=True)
+    timed_out = threading.Event()
+    timer = None
+    if timeout is not None:
+        timer = threading.Timer(timeout, lambda: (timed_out.set(), stop_process_group(proc)))
+        timer.daemon = True
+        timer.start()
+    try:
+        for line in proc.stdout:
+            yield line.rstrip('\n')
+        proc.wait()
+        if proc.returncode != 0:
+            status = 'exit code {}'.format(proc.returncode)
+    finally:
+        if timer is not None:
+            timer.cancel()
+        if proc.poll() is None:
+            status = 'stopped'
+            stop_process_group(proc)
+        if timed_out.is_set():
+            status = 'timeout'
+        proc.stdout.close()
+        record_subprocess(cmd, time.monotonic() - start, status)
+        if info is not None:
+            info['status'] = status
+            info['returncode'] = proc.returncode
+
+def run_streaming(cmd: str, expected: list = (), forbidden: list = (), timeout: float = None,
+                  on_line=None, stop_on_expected: bool = True,
+                  tail_lines: int = STREAM_TAIL_LINES):
+    """
+    Запуск процесса с проверкой вывода по мере его появления.
+    expected - подстроки, которые должны встретиться все, forbidden - ни одна.
+    Процесс завершается, как только результат известен: найдена запрещенная подстрока,
+    найдены все ожидаемые (stop_on_expected) или on_line(line) вернул True.
+    В памяти хранятся только последние tail_lines строк вывода.
+    Возвращает словарь: passed, reason, status, returncode, tail
+    """
+    missing = list(expected)
+    forbidden_found = ''
+    tail = collections.deque(maxlen=tail_lines)
+    info = dict()
+    with contextlib.closing(iter_subprocess_lines(cmd, timeout, info)) as lines:
+        for line in lines:
+            tail.append(line)
+            missing = [marker for marker in missing if marker not in line]
+            forbidden_found = next((marker for marker in forbidden if marker in line), '')
+            if forbidden_found:
+                break
+            if on_line is not None and on_line(line):
+                break
+            if stop_on_expected and len(expected) > 0 and len(missing) == 0:
+                break
+
+    reason = ''
+    if forbidden_found:
+        reason = 'Unexpected output: {}'.format(forbidden_found)
+    elif info['status'] == 'timeout':
+        reason = 'Timeout after {} s'.format(timeout)
+    elif info['status'] not in ['ok', 'stopped']:
+        reason = info['status'].capitalize()
+    elif len(missing) > 0:
+        reason = 'Expected output was not found: {}'.format(', '.join(missing))
+    return {'passed': reason == '', 'reason': reason, 'status': info['status'],
+            'returncode': info['returncode'], 'tail': list(tail)}
+
+def assert_streaming(cmd: str, **kwargs):
+    """
+    run_streaming с выводом последних строк и ошибки, если проверка не пройдена
+    """
+    result = run_streaming(cmd, **kwargs)
+    if not result['passed']:
+        for line in result['tail']:
+            print(line)
+        cgn.console.print_error('{}: {}'.format(cmd, result['reason']))
+    assert result['passed'], result['reason']
+    return result
+
+def run_subprocess(cmd: str, **kwargs):
+    """
+    run_subprocess
+    """
+    return profile_subprocess(cgn.utils.run_subprocess, cmd, **kwargs)
+
+def run_subprocess_str(cmd: str, **kwargs):
+    """
+    run_subprocess_str
+    """
+    return profile_subprocess(cgn.utils.run_subprocess_str, cmd, **kwargs)
+
+def run_subprocess_int(cmd: str, **kwargs):
+    """
+    run_subprocess_int
+    """
+    return profile_subprocess(cgn.utils.run_subprocess_int, cmd, **kwargs)
+
+# Фикстуры нужны только при запуске через pytest: при запуске скрипта напрямую
+# и при импорте из других скриптов pytest не загружается
+if 'pytest' in sys.modules:
+    import pytest
+
+    @pytest.fixture(name='ctx')
+    def fixture_ctx():
+        """
+        Фикстура с параметрами запуска
+        """
+        return get_diagnostics_context()
+
+    class ReportPlugin:
+        """
+        Статус и причина результата теста из отчетов pytest: ошибка assert - failed,
+        другое исключение - error, пропуск (в том числе по кэшу) - skipped
+        """
+        @pytest.hookimpl(hookwrapper=True)
+        def pytest_runtest_makereport(self, item, call):  # pylint: disable=no-self-use
+            """
+            pytest_runtest_makereport
+            """
+            outcome = yield
+            report = outcome.get_result()
+            item.diagnostics_duration = getattr(item, 'diagnostics_duration', 0.0) + \
+                report.duration
+            if not report.passed and not hasattr(item, 'diagnostics_result'):
+                if report.skipped:
+                    reason = report.longrepr[2] if isinstance(report.longrepr, tuple) \
+                        else str(report.longrepr)
+                    status = 'skipped'
+                    reason = reason[len('Skipped: '):] if reason.startswith('Skipped: ') \
+                        else reason
+                elif call.excinfo is not None:
+                    status = 'failed' if call.excinfo.errisinstance(AssertionError) \
+                        else 'error'
+                    reason = get_failure_reason(call.excinfo.value)
+                else:
+                    status = 'error'
+                    reason = str(report.longrepr).strip().split('\n')[-1]
+                item.diagnostics_result = {'status': status, 'reason': reason}
+            if report.when == 'teardown' and not getattr(item, 'diagnostics_reported', False):
+                # fixture_profile не дошел до yield (пропуск или ошибка при подготовке)
+                result = make_empty_result(item.name, 'passed', '', item.diagnostics_duration)
+                result.update(getattr(item, 'diagnostics_result', dict()))
+                REPORT_RESULTS.append(result)
+
+    @pytest.fixture(autouse=True)
+    def fixture_profile(request):
+        """
+        Сбор статистики теста при запуске через pytest.
+        Кэширование результатов отключается переменной окружения DIAGNOSTICS_NO_CACHE=1
+        """
+        name = request.node.name
+        cache_key = None
+        if os.environ.get('DIAGNOSTICS_NO_CACHE') != '1':
+            cached_time, cache_key = get_cached_result(get_diagnostics_context(), name)
+            if cached_time is not None:
+                pytest.skip(get_cached_reason(cached_time))
+        start_profile(name)
+        start = time.monotonic()
+        yield
+        result = {'name': name, 'status': 'passed', 'reason': '',
+                  'duration': time.monotonic() - start}
+        result.update(getattr(request.node, 'diagnostics_result', dict()))
+        result.update(stop_profile())
+        request.node.diagnostics_reported = True
+        REPORT_RESULTS.append(result)
+        if result['status'] == 'passed' and cache_key is not None:
+            save_cached_result(name, cache_key)
+
+    @pytest.fixture(autouse=True, scope='session')
+    def fixture_report(request):
+        """
+        Сохранение json-отчета в файл из переменной окружения DIAGNOSTICS_REPORT
+        """
+        if not request.config.pluginmanager.has_plugin('diagnostics_report'):
+            request.config.pluginmanager.register(ReportPlugin(), 'diagnostics_report')
+        started = datetime.datetime.now()
+        yield
+        report_path = os.environ.get('DIAGNOSTICS_REPORT')
+        if report_path:
+            save_report(report_path, make_report(REPORT_RESULTS, started))
+
+def make_report(results: list, started):
+    """
+    Формирование отчета о запуске
+    """
+    ctx = get_diagnostics_context()
+    try:
+        version = ctx.version
+    except Exception:  # pylint: disable=broad-except
+        version = ''
+    return {
+        'hostname': platform.node(),
+        'version': version,
+        'board_model': ctx.board_model,
+        'arch': ctx.arch,
+        'started': started.isoformat(),
+        'duration': (datetime.datetime.now() - started).total_seconds(),
+        'tests': results}
+
+def save_report(path: str, report: dict):
+    """
+    Сохранение json-отчета, '-' - вывод в stdout
+    """
+    if path == '-':
+        print(json.dumps(report, indent=2))
+    else:
+        with open(path, 'w') as report_file:
+            json.dump(report, report_file, indent=2)
+
+def save_junit_report(path: str, report: dict):
+    """
+    Сохранение отчета в формате JUnit XML
+    """
+    tests = report['tests']
+    suite = ET.Element('testsuite', {
+        'name': 'diagnostics', 'hostname': report['hostname'],
+        'timestamp': report['started'], 'time': '{:.3f}'.format(report['duration']),
+        'tests': str(len(tests)),
+        'failures': str(len([test for test in tests if test['status'] == 'failed'])),
+        'errors': str(len([test for test in tests if test['status'] == 'error'])),
+        'skipped': str(len([test for test in tests if test['status'] == 'skipped']))})
+    for test in tests:
+        case = ET.SubElement(suite, 'testcase', {
+            'classname': 'diagnostics', 'name': test['name'],
+            'time': '{:.3f}'.format(test['duration'])})
+        properties = ET.SubElement(case, 'properties')
+        for key in ['subprocess_count', 'subprocess_time']:
+            ET.SubElement(properties, 'property', {'name': key, 'value': str(test[key])})
+        for key, value in sorted(test['metrics'].items()):
+            ET.SubElement(properties, 'property', {'name': key, 'value': str(value)})
+        for key, values in sorted(test.get('resources', dict()).items()):
+            for stat in ['min', 'avg', 'max']:
+                ET.SubElement(properties, 'property', {
+                    'name': '{}_{}'.format(key, stat), 'value': str(values[stat])})
+        if test['status'] == 'failed':
+            ET.SubElement(case, 'failure', {'message': test['reason']})
+        elif test['status'] == 'error':
+            ET.SubElement(case, 'error', {'message': test['reason']})
+        elif test['status'] == 'skipped':
+            ET.SubElement(case, 'skipped', {'message': test['reason']})
+    ET.ElementTree(suite).write(path, encoding='utf-8', xml_declaration=True)
+
+REDIS_POOLS = dict()
+REDIS_POOLS_LOCK = threading.Lock()
 
 def connect2redis_db(db_num: int):
     """
-    connect2redis_db
+    Возвращает подключение к базе db_num из общего для всего запуска пула
     """
-    conn = cgn.redis.Redis()
-    run_suffix = get_info_version()
-    assert conn.connect(cgn.redis.get_server_ip(run_suffix), 6379, 60, None, db_num)
-    return conn
+    with REDIS_POOLS_LOCK:
+        if db_num not in REDIS_POOLS:
+            pool = redis.ConnectionPool(
+                host=cgn.redis.get_server_ip(get_info_version()), port=6379, db=db_num,
+                socket_connect_timeout=REDIS_CONNECT_TIMEOUT,
+                socket_timeout=REDIS_SOCKET_TIMEOUT, decode_responses=True)
+            assert wait_for_redis(redis.Redis(connection_pool=pool))
+            REDIS_POOLS[db_num] = pool
+    return redis.Redis(connection_pool=REDIS_POOLS[db_num])
 
-def test_all_redis_connection():
+def wait_for_redis(conn, timeout: float = REDIS_WAIT_TIMEOUT):
     """
-    test_all_redis_connection
+    Ожидание готовности redis: короткие попытки подключения с растущей паузой
     """
-    connect2redis_db(1)
-    connect2redis_db(4)
+    deadline = time.monotonic() + timeout
+    delay = REDIS_CONNECT_TIMEOUT
+    while True:
+        try:
+            return conn.ping()
+        except redis.exceptions.RedisError as exc:
+            if time.monotonic() + delay > deadline:
+                cgn.console.print_error('Redis is not available: {}'.format(exc))
+                return False
+            print('Redis is not ready ({}), retry in {:.1f} s'.format(exc, delay))
+            time.sleep(delay)
+            delay = min(delay * 2, REDIS_MAX_BACKOFF)
 
-def iperf(mode):
+def close_redis_pools():
     """
-    iperf
+    Закрытие всех подключений к redis
     """
-    device_ip = '192.168.10.10'
-    cgn.utils.run_subprocess(
-        "timeout 2 ssh agrodroid@{} -f 'iperf3 -s 1>/dev/null 2>/dev/null'".format(
-            device_ip), use_assert=True)
-    out = cgn.utils.run_subprocess_str(
-        'sleep 3 && iperf3 {} -c {}'.format(mode, device_ip), use_assert=True)
-    cgn.utils.run_subprocess(
-        "timeout 2 ssh agrodroid@{} -f 'killall iperf3'".format(device_ip), use_assert=True)
-    return out
+    with REDIS_POOLS_LOCK:
+        for pool in REDIS_POOLS.values():
+            pool.disconnect()
+        REDIS_POOLS.clear()
 
-def process_iperf_output(out):
+def test_all_redis_connection():
     """
-    process_iperf_output
+    Проверка доступности redis: ping при каждом запуске, а не только при создании пула
     """
-    for line in out.split('\n'):
-        if 'sender' in line:
-            assert float(line.split()[4]) > 80.0
-        if 'receiver' in line:
-            assert float(line.split()[4]) > 80.0
+    assert wait_for_redis(connect2redis_db(1))
+    assert wait_for_redis(connect2redis_db(4))
 
-def test_aarch64_eth_speed():
+def wait_for_port(host: str, port: int, timeout: float):
+    """
+    Ожидание, пока порт начнет принимать подключения
+    """
+    deadline = time.monotonic() + timeout
+    while time.monotonic() < deadline:
+        try:
+            with socket.create_connection((host, port), timeout=0.5):
+                return True
+        except OSError:
+            time.sleep(0.1)
+    return False
+
+def get_iperf_version():
+    """
+    Версия iperf3 в виде кортежа (major, minor)
+    """
+    match = re.search(r'iperf (\d+)\.(\d+)', run_subprocess_str('iperf3 --version'))
+    if match is None:
+        return (0, 0)
+    return (int(match.group(1)), int(match.group(2)))
+
+def run_iperf_client(device_ip: str, options: str):
+    """
+    Запуск iperf3-клиента с json-выводом
+    """
+    lines = []
+
+    def on_line(line):
+        lines.append(line)
+
+    # -i 0: без промежуточных отчетов, размер вывода не зависит от длительности теста
+    result = run_streaming('iperf3 -c {} -p {} -t {} -i 0 -J {}'.format(
+        device_ip, IPERF_PORT, IPERF_DURATION, options),
+        timeout=IPERF_DURATION + IPERF_SERVER_TIMEOUT + 10, on_line=on_line)
+    if result['status'] == 'timeout':
+        return {'error': result['reason']}
+    out = '\n'.join(lines)
+    try:
+        return json.loads(out)
+    except ValueError:
+        return {'error': out.strip() or 'No output'}
+
+def parse_iperf_json(data: dict, prefix: str = ''):
+    """
+    Разбор json-вывода iperf3. Возвращает словарь {направление: {параметр: значение}}
+    """
+    assert 'error' not in data, data.get('error')
+    test_start = data['start']['test_start']
+    end = data['end']
+    directions = [('reversed' if test_start.get('reverse') else 'normal', '')]
+    if test_start.get('bidir'):
+        directions.append(('reversed', '_bidir_reverse'))
+    results = dict()
+    for direction, suffix in directions:
+        if test_start.get('protocol') == 'UDP':
+            total = end['sum' + suffix]
+            results[prefix + direction] = {
+                'receiver_mbits': total['bits_per_second'] / 1e6,
+                'jitter_ms': total['jitter_ms'],
+                'lost_percent': total['lost_percent']}
+        else:
+            sent = end['sum_sent' + suffix]
+            results[prefix + direction] = {
+                'sender_mbits': sent['bits_per_second'] / 1e6,
+                'receiver_mbits': end['sum_received' + suffix]['bits_per_second'] / 1e6,
+                'retransmits': sent.get('retransmits', 0)}
+    return results
+
+def iperf_benchmark(device_ip: str):
+    """
+    Измерение скорости канала в обе стороны за один запуск iperf3-сервера.
+    При поддержке --bidir (iperf3 >= 3.7) оба направления измеряются одновременно
+    """
+    run_subprocess(
+        "timeout 2 ssh agrodroid@{} -f 'iperf3 -s -p {} 1>/dev/null 2>/dev/null'".format(
+            device_ip, IPERF_PORT), use_assert=True)
+    try:
+        assert wait_for_port(device_ip, IPERF_PORT, IPERF_SERVER_TIMEOUT), \
+            'iperf3 server on {} is not available'.format(device_ip)
+        data = {'error': 'iperf3 --bidir is not supported'}
+        if get_iperf_version() >= (3, 7):
+            data = run_iperf_client(device_ip, '--bidir')
+        if 'error' not in data:
+            results = parse_iperf_json(data)
+        else:
+            print('{}, measuring directions one by one'.format(data['error']))
+            results = parse_iperf_json(run_iperf_client(device_ip, ''))
+            results.update(parse_iperf_json(run_iperf_client(device_ip, '-R')))
+        if IPERF_UDP_BITRATE:
+            for option in ['', '-R']:
+                results.update(parse_iperf_json(run_iperf_client(
+                    device_ip, '-u -b {} {}'.format(IPERF_UDP_BITRATE, option)), 'udp_'))
+    finally:
+        run_subprocess(
+            "timeout 2 ssh agrodroid@{} -f 'killall iperf3'".format(device_ip))
+    return results
+
+def check_iperf_results(results: dict):
+    """
+    Сравнение результатов iperf3 с порогами, возвращает список ошибок
+    """
+    errors = []
+    for direction, values in sorted(results.items()):
+        for key in ['sender_mbits', 'receiver_mbits']:
+            if 'jitter_ms' not in values and key in values and values[key] <= IPERF_MIN_MBITS:
+                errors.append('{} {}: {:.1f} <= {}'.format(
+                    direction, key, values[key], IPERF_MIN_MBITS))
+        if IPERF_MAX_RETRANSMITS is not None and \
+                values.get('retransmits', 0) > int(IPERF_MAX_RETRANSMITS):
+            errors.append('{} retransmits: {} > {}'.format(
+                direction, values['retransmits'], IPERF_MAX_RETRANSMITS))
+        if values.get('jitter_ms', 0) > IPERF_MAX_JITTER_MS:
+            errors.append('{} jitter_ms: {:.3f} > {}'.format(
+                direction, values['jitter_ms'], IPERF_MAX_JITTER_MS))
+        if values.get('lost_percent', 0) > IPERF_MAX_LOST_PERCENT:
+            errors.append('{} lost_percent: {:.2f} > {}'.format(
+                direction, values['lost_percent'], IPERF_MAX_LOST_PERCENT))
+    return errors
+
+def append_history(name: str, ctx, values: dict):
+    """
+    Добавление результата измерения в историю (ключ - версия образа и модель платы)
+    """
+    path = get_cache_path('{}_history.json'.format(name))
+    history = load_json_file(path, [])
+    history.append({
+        'time': datetime.datetime.now().isoformat(), 'version': ctx.version,
+        'board_model': ctx.board_model, 'values': values})
+    save_json_file(path, history[-BENCHMARK_HISTORY_SIZE:])
+    return history
+
+def test_aarch64_eth_speed(ctx):
     """
     test_aarch64_eth_speed
     """
-    model = cgn.utils.run_subprocess_str('cat /proc/device-tree/model', use_assert=True)
-    if 'quill' not in model:
-        modes = {'normal':'', 'reversed':'-R'}
-        for mode in modes:
-            print('mode: ', mode)
-            out = iperf(modes[mode])
-            assert 'Connection refused' not in out
-            assert 'No route to host' not in out
-            process_iperf_output(out)
+    if 'quill' not in ctx.board_model:
+        results = iperf_benchmark(IPERF_SERVER_IP)
+        append_history('iperf', ctx, results)
+        for direction, values in sorted(results.items()):
+            print('{}: {}'.format(direction, values))
+            for key, value in values.items():
+                record_metric('iperf_{}_{}'.format(direction, key), value)
+        errors = check_iperf_results(results)
+        for error in errors:
+            cgn.console.print_warning(error)
+        assert len(errors) == 0
 
 def test_all_docker_version():
     """
@@ -95,22 +1006,119 @@ def get_flycap_bin_dir():
     Возвращает директорию, в которой лежат исполняемые файлы flycap
     """
     flycap_bin_dir = ''
-    arch = platform.machine()
-    if arch == 'aarch64':
+    if get_diagnostics_context().arch == 'aarch64':
         flycap_bin_dir = get_flycap_bin_dir_aarch64()
     return flycap_bin_dir
 
-def test_all_deb_packages():
+def get_deb_packages(ctx):
     """
-    Проверка наличия deb-пакет
+    Список обязательных deb-пакетов для текущей архитектуры
     """
     packages = ['jq', 'ethtool', 'arp-scan', 'expect']
-    arch = platform.machine()
+    arch = ctx.arch
     if arch == 'x86_64':
         packages.extend(['libgtkmm-2.4-1v5:amd64'])
     elif arch == 'aarch64':
         packages.extend(['libgtkmm-2.4-1v5:arm64', 'docker', 'docker.io'])
-    cgn.test.check_deb_packages(packages)
+    return packages
+
+PACKAGE_INDEX = dict()
+PACKAGE_INDEX_LOCK = threading.Lock()
+
+def parse_dpkg_status(path: str):
+    """
+    Множество установленных deb-пакетов (имя и имя:архитектура) из файла статуса dpkg
+    """
+    installed = set()
+    with open(path, 'r', encoding='utf-8', errors='replace') as status_file:
+        paragraphs = status_file.read().split('\n\n')
+    for paragraph in paragraphs:
+        fields = dict()
+        for line in paragraph.split('\n'):
+            if line.startswith(('Package:', 'Status:', 'Architecture:')):
+                key, value = line.split(':', 1)
+                fields[key] = value.strip()
+        if 'Package' not in fields or not fields.get('Status', '').endswith(' installed'):
+            continue
+        installed.add(fields['Package'])
+        if fields.get('Architecture', 'all') != 'all':
+            installed.add('{}:{}'.format(fields['Package'], fields['Architecture']))
+    return installed
+
+def get_installed_deb_packages(status_path: str = '/var/lib/dpkg/status'):
+    """
+    Установленные deb-пакеты. Файл статуса dpkg перечитывается только после изменения
+    """
+    mtime = get_mtime(status_path)
+    with PACKAGE_INDEX_LOCK:
+        cached = PACKAGE_INDEX.get('deb')
+        if cached is None or cached[0] != mtime:
+            PACKAGE_INDEX['deb'] = (mtime, parse_dpkg_status(status_path))
+        return PACKAGE_INDEX['deb'][1]
+
+def normalize_pip_name(name: str):
+    """
+    normalize_pip_name
+    """
+    return re.sub(r'[-_.]+', '-', name).lower()
+
+def get_distribution_names():
+    """
+    Имена установленных python-пакетов: importlib.metadata (Python 3.8+), backport
+    importlib_metadata или pkg_resources (Python 3.6 в образах JetPack 4).
+    Если ни один модуль недоступен, возникает ImportError
+    """
+    for module_name in ['importlib.metadata', 'importlib_metadata']:
+        try:
+            metadata = importlib.import_module(module_name)
+        except ImportError:
+            continue
+        return [dist.metadata['Name'] for dist in metadata.distributions()
+                if dist.metadata['Name']]
+    import pkg_resources  # pylint: disable=import-outside-toplevel
+    return [dist.project_name for dist in pkg_resources.working_set]
+
+def get_installed_pip_packages():
+    """
+    Установленные python-пакеты (один проход по метаданным пакетов за запуск)
+    """
+    with PACKAGE_INDEX_LOCK:
+        if 'pip' not in PACKAGE_INDEX:
+            PACKAGE_INDEX['pip'] = set(
+                normalize_pip_name(name) for name in get_distribution_names())
+        return PACKAGE_INDEX['pip']
+
+def check_deb_packages(packages: list):
+    """
+    Проверка наличия deb-пакетов
+    """
+    installed = get_installed_deb_packages()
+    missing = [package for package in packages if package not in installed]
+    if len(missing) > 0:
+        cgn.console.print_error('Deb packages were not found: {}'.format(' '.join(missing)))
+        cgn.console.fix_it('sudo apt install {}'.format(' '.join(missing)))
+    assert len(missing) == 0
+
+def check_pip_packages(packages: list):
+    """
+    Проверка наличия python-пакетов
+    """
+    try:
+        installed = get_installed_pip_packages()
+    except ImportError:
+        cgn.test.check_pip_packages(packages)
+        return
+    missing = [package for package in packages if normalize_pip_name(package) not in installed]
+    if len(missing) > 0:
+        cgn.console.print_error('Pip packages were not found: {}'.format(' '.join(missing)))
+        cgn.console.fix_it('pip3 install {}'.format(' '.join(missing)))
+    assert len(missing) == 0
+
+def test_all_deb_packages(ctx):
+    """
+    Проверка наличия deb-пакет
+    """
+    check_deb_packages(get_deb_packages(ctx))
 
 def test_all_docker_compose_version():
     """
@@ -118,69 +1126,265 @@ def test_all_docker_compose_version():
     """
     cgn.test.check_docker_compose_version()
 
-def test_all_docker_compose_config():
+# Подстановка переменных docker compose: $$, $NAME, ${NAME}, ${NAME:-default}, ${NAME?err}...
+COMPOSE_VARIABLE_RE = re.compile(
+    r'\$(?:(\$)|([A-Za-z_][A-Za-z0-9_]*)|\{([A-Za-z_][A-Za-z0-9_]*)(?:(:?[-+?])[^}]*)?\})')
+
+def get_compose_variables(data):
     """
-    test_all_docker_compose_config
+    Переменные, используемые в значениях конфигурации, в виде {имя: есть ли значение по
+    умолчанию}
+    """
+    variables = dict()
+    if isinstance(data, dict):
+        for value in data.values():
+            for name, has_default in get_compose_variables(value).items():
+                variables[name] = variables.get(name, True) and has_default
+    elif isinstance(data, list):
+        for value in data:
+            for name, has_default in get_compose_variables(value).items():
+                variables[name] = variables.get(name, True) and has_default
+    elif isinstance(data, str):
+        for match in COMPOSE_VARIABLE_RE.finditer(data):
+            if match.group(1):
+                continue
+            name = match.group(2) or match.group(3)
+            has_default = (match.group(4) or '').lstrip(':') in ['-', '+']
+            variables[name] = variables.get(name, True) and has_default
+    return variables
+
+def read_env_file(path: str):
+    """
+    Переменные из .env-файла docker compose
+    """
+    env = dict()
+    for line in read_str_from_file_safe(path).split('\n'):
+        line = line.strip()
+        if line and not line.startswith('#') and '=' in line:
+            key, value = line.split('=', 1)
+            env[key.replace('export ', '', 1).strip()] = value.strip()
+    return env
+
+def get_cmd_env(cmd: str):
+    """
+    Переменные, которые задаются в самой команде (NAME=value cmd, export NAME=value)
+    """
+    return set(re.findall(r'(?:^|[\s;&])(?:export\s+)?([A-Za-z_][A-Za-z0-9_]*)=', cmd))
+
+def get_unset_compose_variables(data, base_cmd: str, env_file: str):
+    """
+    Переменные без значения по умолчанию, не заданные ни в окружении, ни в .env,
+    ни в команде запуска docker compose
+    """
+    defined = set(os.environ) | set(read_env_file(env_file)) | get_cmd_env(base_cmd)
+    return sorted(name for name, has_default in get_compose_variables(data).items()
+                  if not has_default and name not in defined)
+
+def get_compose_args(ctx):
+    """
+    Аргументы app_manager для формирования команды docker compose
     """
-    script_dir = os.path.dirname(os.path.abspath(__file__))
     parser = argparse.ArgumentParser()
     args = parser.parse_args([])
-    args.arch = platform.machine()
+    args.arch = ctx.arch
     args.abort_on_container_exit = False
     args.app_dir = '/tmp'
     args.container_mode = 'all'
     args.force_recreate = False
-    args.minimal_version_dir = os.path.abspath(os.path.join(script_dir, '..'))
+    args.minimal_version_dir = ctx.minimal_version_dir
     args.no_color = False
     args.popcore_version = 3
-    args.run_suffix = '-' + get_info_version()
+    args.run_suffix = '-' + ctx.version
     args.without_detached = False
-    args.info_version = cgn.utils.read_str_from_file(
-        os.path.abspath(os.path.join(script_dir, '..', 'info', 'version.txt')))
+    args.info_version = ctx.version
     args.redis_address = cgn.redis.get_server_ip(args.info_version)
 
-    yaml_config = app_manager.get_default_config()
-    data = cgn.utils.load_yaml(yaml_config)
-    services = list(data['services'].keys())
+    services = list(ctx.compose_data['services'].keys())
     if 'sys_agro_monitor' in services:
         args.update_mode = True
     else:
         args.update_mode = False
 
-    args.path_autostart = os.path.abspath(os.path.join(script_dir, yaml_config))
+    args.path_autostart = os.path.abspath(os.path.join(ctx.script_dir, ctx.compose_config))
+    return args
+
+def render_compose_config(ctx, args, base_cmd: str):
+    """
+    Проверка конфигурации командой docker compose config.
+    Успешный результат кэшируется по хэшу конфигурации, команды и используемых переменных
+    """
+    variables = sorted(get_compose_variables(ctx.compose_data))
+    key = hashlib.sha256()
+    for part in [read_str_from_file_safe(args.path_autostart), base_cmd,
+                 read_str_from_file_safe(os.path.join(
+                     os.path.dirname(args.path_autostart), '.env')),
+                 json.dumps([(name, os.environ.get(name)) for name in variables]),
+                 str(get_mtime(shutil.which('docker') or '/usr/bin/docker'))]:
+        key.update(part.encode('utf-8'))
+    key = key.hexdigest()
+
+    cache_path = get_cache_path('compose_config.json')
+    cache = load_json_file(cache_path, dict())
+    if key in cache:
+        print('docker compose config: cached result from {}'.format(cache[key]['time']))
+        return cache[key]['services']
+
+    assert_streaming(base_cmd, expected=['services'], forbidden=['variable is not set'],
+                     timeout=COMPOSE_CONFIG_TIMEOUT, stop_on_expected=False)
+    cache = dict(sorted(cache.items(), key=lambda item: item[1]['time'])[-20:])
+    cache[key] = {
+        'time': datetime.datetime.now().isoformat(),
+        'services': sorted(ctx.compose_data['services'].keys())}
+    save_json_file(cache_path, cache)
+    return cache[key]['services']
+
+def test_all_docker_compose_config(ctx):
+    """
+    test_all_docker_compose_config
+    """
+    args = get_compose_args(ctx)
     base_cmd = app_manager.get_docker_compose_cmd(args, 'config')
-    result_str = cgn.utils.run_subprocess_str(base_cmd, use_assert=True, verbose=False)
-    print(result_str)
-    assert 'services' in result_str
-    assert 'variable is not set' not in result_str
+    unset = get_unset_compose_variables(
+        ctx.compose_data, base_cmd, os.path.join(os.path.dirname(args.path_autostart), '.env'))
+    if len(unset) > 0:
+        cgn.console.print_error('Variables are not set: {}'.format(' '.join(unset)))
+        assert False
+    render_compose_config(ctx, args, base_cmd)
+
+def get_vehicle_dict(all_harvesters: bool = False):
+    """
+    Возвращает db4.vehicle:model, соответствующую запись db1.harvesters_dict и,
+    если all_harvesters, все записи harvesters_dict. Все читается за один запрос к redis
+    """
+    result = connect2redis_db(1).eval(
+        VEHICLE_DICT_SCRIPT, 0, 4, 1, '1' if all_harvesters else '0')
+    harvesters = dict()
+    for num in range(2, len(result), 2):
+        harvesters[result[num][len('harvesters_dict:'):]] = result[num + 1]
+    return result[0], result[1], harvesters
+
+def check_vehicle_data(vehicle_name: str, vehicle_data_str: str):
+    """
+    Проверка записи harvesters_dict, возвращает текст ошибки или пустую строку
+    """
+    if len(vehicle_data_str) == 0:
+        return 'Incorrect db4.vehicle:model or db1:harvesters_dict[db4.vehicle:model]'
+    if 'nameString' not in vehicle_data_str:
+        return 'Field \'nameString\' was not found in vehicle_data'
+    if vehicle_name not in vehicle_data_str:
+        return 'Incorrect vehicle_name!'
+    return ''
 
 def test_all_vehicle_dict():
     """
     test_all_vehicle_dict
     """
-    redis_server_db4 = connect2redis_db(4)
-    vehicle_name = redis_server_db4.get('vehicle:model')
+    vehicle_name, vehicle_data_str, _ = get_vehicle_dict()
     print('vehicle_name: ', vehicle_name)
-
-    redis_server_db1 = connect2redis_db(1)
-    vehicle_data_str = redis_server_db1.get('harvesters_dict:{}'.format(vehicle_name))
     print('vehicle_data_str: ', vehicle_data_str)
 
-    if len(vehicle_data_str) == 0:
-        print('Incorrect db4.vehicle:model or db1:harvesters_dict[db4.vehicle:model]')
-        assert False
-    elif 'nameString' not in vehicle_data_str:
-        print('Field \'nameString\' was not found in vehicle_data')
-        assert False
-    elif vehicle_name not in vehicle_data_str:
-        print('Incorrect vehicle_name!')
+    error = check_vehicle_data(vehicle_name, vehicle_data_str)
+    if len(error) > 0:
+        print(error)
         assert False
 
-def test_all_culture_model_mapping():
+def test_all_harvesters_dict():
+    """
+    Проверка всех записей db1.harvesters_dict
+    """
+    _, _, harvesters = get_vehicle_dict(all_harvesters=True)
+    status = len(harvesters) > 0
+    for vehicle_name, vehicle_data_str in sorted(harvesters.items()):
+        error = check_vehicle_data(vehicle_name, vehicle_data_str)
+        if len(error) > 0:
+            cgn.console.print_warning('{}: {}'.format(vehicle_name, error))
+            status = False
+    assert status
+
+def hash_file_sha256(path: str):
+    """
+    sha256 файла, читаемого через mmap блоками по MODEL_HASH_CHUNK байт
+    """
+    digest = hashlib.sha256()
+    with open(path, 'rb') as data_file:
+        if os.fstat(data_file.fileno()).st_size > 0:
+            with mmap.mmap(data_file.fileno(), 0, access=mmap.ACCESS_READ) as data, \
+                    memoryview(data) as view:
+                for offset in range(0, len(view), MODEL_HASH_CHUNK):
+                    digest.update(view[offset:offset + MODEL_HASH_CHUNK])
+    return digest.hexdigest()
+
+MODEL_DIGESTS_LOCK = threading.Lock()
+
+def get_file_digests(paths: list):
+    """
+    sha256 файлов {путь: digest}. Суммы кэшируются по (путь, размер, mtime, inode),
+    пересчитываются только новые и измененные файлы (параллельно)
+    """
+    cache_path = get_cache_path('model_digests.json')
+    with MODEL_DIGESTS_LOCK:
+        cache = load_json_file(cache_path, dict())
+        digests = dict()
+        stale = dict()
+        for path in paths:
+            path = os.path.abspath(path)
+            file_stat = os.stat(path)
+            key = [file_stat.st_size, file_stat.st_mtime_ns, file_stat.st_ino]
+            record = cache.get(path)
+            if record is not None and record[:3] == key:
+                digests[path] = record[3]
+            else:
+                stale[path] = key
+        if stale:
+            with concurrent.futures.ThreadPoolExecutor(max_workers=MODEL_HASH_JOBS) as executor:
+                for path, digest in zip(stale, executor.map(hash_file_sha256, stale)):
+                    digests[path] = digest
+                    cache[path] = stale[path] + [digest]
+            cache = dict((path, record) for path, record in cache.items()
+                         if os.path.exists(path))
+            save_json_file(cache_path, cache)
+        record_metric('hashed_files', len(stale))
+        record_metric('hashed_bytes', sum(key[0] for key in stale.values()))
+    return digests
+
+def read_sha256_manifest(path: str):
+    """
+    Разбор файла в формате sha256sum: {относительный путь: digest}
+    """
+    manifest = dict()
+    with open(path, 'r') as manifest_file:
+        for line in manifest_file:
+            line = line.strip()
+            if len(line) == 0 or line.startswith('#'):
+                continue
+            digest, name = line.split(None, 1)
+            manifest[os.path.normpath(name.lstrip('*'))] = digest.lower()
+    return manifest
+
+def check_models_integrity(ctx, paths: list):
+    """
+    Сверка sha256 файлов моделей с MODELS_MANIFEST.
+    Возвращает список ошибок, пустой список - если манифеста нет
+    """
+    manifest_path = os.path.join(ctx.minimal_version_dir, MODELS_MANIFEST)
+    if not os.path.exists(manifest_path):
+        cgn.console.print_warning('No models manifest: {}'.format(manifest_path))
+        return []
+    manifest = read_sha256_manifest(manifest_path)
+    errors = []
+    for path, digest in sorted(get_file_digests(paths).items()):
+        name = os.path.relpath(path, ctx.minimal_version_dir)
+        if name not in manifest:
+            cgn.console.print_warning('Model is not in manifest: {}'.format(name))
+        elif manifest[name] != digest:
+            errors.append('Checksum mismatch: {}'.format(path))
+    return errors
+
+def test_all_culture_model_mapping(ctx):
     """
     test_all_culture_model_mapping
     """
-    script_dir = os.path.dirname(os.path.abspath(__file__))
+    script_dir = ctx.script_dir
     agrodroid_path = os.path.join(
         script_dir, '..', 'base', 'containers', 'main', 'config', 'npme', 'agrodroid.yml.main')
 
@@ -191,116 +1395,208 @@ def test_all_culture_model_mapping():
     print(agrodroid_data['rules'])
     work_types = []
     expected_work_types = ['left', 'row', 'valok']
+    errors = []
+    paths = []
     for rule in agrodroid_data['rules']:
         assert 'work_type' in rule or 'culture' in rule
         assert 'net' in rule
         path = os.path.join(script_dir, rule['net'].replace('models', 'containers/main/models_ext'))
         print(path)
-        if not os.path.exists(path):
-            cgn.console.print_error(
-                'File was not found: {}'.format(path))
-            assert False
+        if not os.path.isfile(path):
+            errors.append('File was not found: {}'.format(path))
+        elif os.path.getsize(path) == 0:
+            errors.append('File is empty: {}'.format(path))
+        else:
+            paths.append(path)
         if 'work_type' in rule:
             assert rule['work_type'] in expected_work_types
             work_types.append(rule['work_type'])
+    if MODEL_INTEGRITY:
+        errors.extend(check_models_integrity(ctx, paths))
+    for error in errors:
+        cgn.console.print_error(error)
+    assert len(errors) == 0, '; '.join(errors)
     assert set(work_types) == set(expected_work_types)
 
 def get_info_version():
     """
     get_info_version
     """
-    script_dir = os.path.dirname(os.path.abspath(__file__))
-    return cgn.utils.read_str_from_file(
-        os.path.join(script_dir, '..', 'info', 'version.txt'))
+    return get_diagnostics_context().version
 
 def get_major_image_version():
     """
     get_major_image_version
     """
-    version_str = get_info_version()
-    return int(version_str[version_str.find('-v')+2:])
-
-def test_all_symlinks():
+    return get_diagnostics_context().major_image_version
+
+# Структура директории версии: (тип, путь относительно minimal_version_dir, условие).
+# Типы: 'link' - символическая ссылка, 'dir' - директория, 'file' - файл,
+# 'exec' - исполняемый файл. Условие - ключ LAYOUT_CONDITIONS или None (проверять всегда)
+LAYOUT_MANIFEST = [
+    ('link', 'containers/main/config', None),
+    ('link', 'containers/main/data', None),
+    ('link', 'containers/main/models', None),
+    ('link', 'containers/main/lib/libflycapture.so.2', 'image<44'),
+    ('link', 'containers/main/bin/onnx2trt', 't51'),
+    ('link', 'containers/main/lib/libnvonnxparser_runtime.so.0', 't51'),
+
+    ('dir', 'info', None),
+    ('dir', 'scripts', None),
+    ('dir', 'containers/main/bin', None),
+    ('dir', 'containers/main/lib', None),
+    ('dir', 'containers/main/prj.scripts', None),
+    ('dir', 'containers/main/testdata', None),
+    ('dir', 'base_src/docker', 'no_onnx_patch'),
+    ('dir', 'base_src/docker/autoheal', 'no_onnx_patch'),
+    ('dir', 'base_src/containers/dir_cleaner', 'no_onnx_patch'),
+    ('dir', 'base_src/containers/dir_monitor', 'no_onnx_patch'),
+    ('dir', 'base_src/containers/main', 'no_onnx_patch'),
+    ('dir', 'base_src/containers/main/bin', 'no_onnx_patch'),
+    ('dir', 'base_src/containers/main/config', 'no_onnx_patch'),
+    ('dir', 'base_src/containers/main/data', 'no_onnx_patch'),
+    ('dir', 'base_src/containers/main/lib', 'no_onnx_patch'),
+    ('dir', 'base_src/containers/main/models', 'no_onnx_patch'),
+    ('dir', 'docker/main', 'no_onnx_patch'),
+
+    ('file', 'autocheck.sh', None),
+    ('file', 'autostart.sh', None),
+    ('file', 'stop_containers.sh', None),
+    ('file', 'base/containers/main/config/logger-config.yaml.main', None),
+    ('file', 'base/containers/main/config/navigator/run_keys.txt.main', None),
+    ('file', 'base/containers/main/config/navigator/run_keys.txt.test', None),
+    ('file', 'base/containers/main/config/navigator/online_mode.yaml', None),
+    ('file', 'base/containers/main/config/npme/npme.yml.main', None),
+    ('file', 'base/containers/main/bin/onnx2trt', 't51'),
+    ('file', 'containers/main/bin/npme', None),
+    ('file', 'containers/main/bin/npme_healthcheck', None),
+    ('file', 'containers/main/lib/libtensorrtserver.so', None),
+    ('file', 'scripts/install.py', None),
+    ('file', 'scripts/interactive_start.sh', None),
+    ('file', 'scripts/load_containers.sh', None),
+    ('file', 'scripts/prepare_models.sh', None),
+    ('file', 'scripts/set_flycap_serial_number.py', None),
+
+    ('exec', 'containers/main/bin/npme', None),
+    ('exec', 'containers/main/bin/npme_healthcheck', None),
+    ('exec', 'containers/main/bin/dbw_checker', None),
+]
+
+LAYOUT_CONDITIONS = {
+    'image<44': lambda ctx: ctx.major_image_version < 44,
+    't51': lambda ctx: 't51' in ctx.version,
+    'no_onnx_patch': lambda ctx: 'agrodroid_onnx_patch' not in ctx.version,
+}
+
+def scan_directory(path: str):
+    """
+    Содержимое директории {имя: os.DirEntry}, пустой словарь - директории нет
+    """
+    try:
+        with os.scandir(path) as entries:
+            return dict((entry.name, entry) for entry in entries)
+    except (FileNotFoundError, NotADirectoryError, PermissionError):
+        return dict()
+
+def check_layout_entry(kind: str, entry):
+    """
+    Проверка типа записи директории, возвращает текст ошибки или пустую строку
+    """
+    if entry is None:
+        return 'not found'
+    if kind == 'link' and not entry.is_symlink():
+        return 'not a symlink'
+    if kind == 'dir' and not entry.is_dir():
+        return 'not a directory'
+    if kind in ['file', 'exec'] and not entry.is_file():
+        return 'not a file'
+    if kind == 'exec' and not os.access(entry.path, os.X_OK):
+        return 'not executable'
+    return ''
+
+def check_layout(ctx, kinds: list = None):
+    """
+    Проверка структуры директории версии по LAYOUT_MANIFEST (только типы kinds).
+    Каждая родительская директория читается одним os.scandir.
+    Возвращает список всех ошибок
+    """
+    listings = dict()
+    errors = []
+    for kind, path, condition in LAYOUT_MANIFEST:
+        if kinds is not None and kind not in kinds:
+            continue
+        if condition is not None and not LAYOUT_CONDITIONS[condition](ctx):
+            continue
+        parent, name = os.path.split(path)
+        if parent not in listings:
+            listings[parent] = scan_directory(os.path.join(ctx.minimal_version_dir, parent))
+        error = check_layout_entry(kind, listings[parent].get(name))
+        if error:
+            errors.append('{}: {}'.format(os.path.join(ctx.minimal_version_dir, path), error))
+    return errors
+
+def assert_layout(ctx, kinds: list):
+    """
+    assert_layout
+    """
+    errors = check_layout(ctx, kinds)
+    for error in errors:
+        cgn.console.print_error(error)
+    assert len(errors) == 0, '; '.join(errors)
+
+def test_all_symlinks(ctx):
+    """
+    Проверка наличия символических ссылок
+    """
+    assert_layout(ctx, ['link'])
+
+def test_all_directories(ctx):
     """
     Проверка наличия директорий
     """
-    script_dir = os.path.dirname(os.path.abspath(__file__))
+    assert_layout(ctx, ['dir'])
 
-    paths = [
-        os.path.join('containers', 'main', 'config'),
-        os.path.join('containers', 'main', 'data'),
-        os.path.join('containers', 'main', 'models')]
-    if get_major_image_version() < 44:
-        paths.append(os.path.join('containers', 'main', 'lib', 'libflycapture.so.2'))
-
-    if 't51' in get_info_version():
-        paths.extend([
-            os.path.join('containers', 'main', 'bin', 'onnx2trt'),
-            os.path.join('containers', 'main', 'lib', 'libnvonnxparser_runtime.so.0')])
-    for path in paths:
-        assert os.path.islink(os.path.join(script_dir, '..', path))
+def test_all_files(ctx):
+    """
+    Проверка наличия файлов
+    """
+    assert_layout(ctx, ['file'])
 
-def test_all_directories():
+def get_interactive_start_cmd(ctx, script: str):
     """
-    Проверка наличия директорий
+    Команда запуска shell-скрипта внутри контейнера с помощью interactive_start.sh
     """
-    script_dir = os.path.dirname(os.path.abspath(__file__))
-    directories = [
-        'info', 'scripts',
-        os.path.join('containers', 'main', 'bin'),
-        os.path.join('containers', 'main', 'lib'),
-        os.path.join('containers', 'main', 'prj.scripts'),
-        os.path.join('containers', 'main', 'testdata')]
-    if get_info_version().find('agrodroid_onnx_patch') == -1:
-        directories.extend([
-            os.path.join('base_src', 'docker'),
-            os.path.join('base_src', 'docker', 'autoheal'),
-            os.path.join('base_src', 'containers', 'dir_cleaner'),
-            os.path.join('base_src', 'containers', 'dir_monitor'),
-            os.path.join('base_src', 'containers', 'main'),
-            os.path.join('base_src', 'containers', 'main', 'bin'),
-            os.path.join('base_src', 'containers', 'main', 'config'),
-            os.path.join('base_src', 'containers', 'main', 'data'),
-            os.path.join('base_src', 'containers', 'main', 'lib'),
-            os.path.join('base_src', 'containers', 'main', 'models'),
-            os.path.join('docker', 'main')])
-
-    for directory in directories:
-        assert os.path.isdir(os.path.join(script_dir, '..', directory))
-
-def test_all_files():
+    return '{} sh -c {}'.format(
+        os.path.join(ctx.script_dir, 'interactive_start.sh'), shlex.quote(script))
+
+def check_opencv_yaml_files(ctx, files: list):
     """
-    Проверка наличия файлов
+    Проверка OpenCV YAML файлов (пути относительно /external-dir) скриптом
+    check_opencv_yaml.py: все файлы проверяются за один запуск контейнера.
+    Возвращает словарь {файл: текст ошибки или пустая строка}
     """
-    files = [
-        'autocheck.sh', 'autostart.sh', 'stop_containers.sh',
-        os.path.join('base', 'containers', 'main', 'config', 'logger-config.yaml.main'),
-        os.path.join('base', 'containers', 'main', 'config', 'navigator', 'run_keys.txt.main'),
-        os.path.join('base', 'containers', 'main', 'config', 'navigator', 'run_keys.txt.test'),
-        os.path.join('base', 'containers', 'main', 'config', 'navigator', 'online_mode.yaml'),
-        os.path.join('base', 'containers', 'main', 'config', 'npme', 'npme.yml.main'),
-        os.path.join('containers', 'main', 'bin', 'npme'),
-        os.path.join('containers', 'main', 'bin', 'npme_healthcheck'),
-        os.path.join('containers', 'main', 'lib', 'libtensorrtserver.so'),
-        os.path.join('scripts', 'install.py'),
-        os.path.join('scripts', 'interactive_start.sh'),
-        os.path.join('scripts', 'load_containers.sh'),
-        os.path.join('scripts', 'prepare_models.sh'),
-        os.path.join('scripts', 'set_flycap_serial_number.py')]
-
-    version_str = get_info_version()
-    if 't51' in version_str:
-        files.append(os.path.join('base', 'containers', 'main', 'bin', 'onnx2trt'))
-
-    cgn.test.check_files(__file__, files)
-
-def test_all_yaml():
+    files = list(dict.fromkeys(files))
+    paths = [os.path.join('/external-dir', file) for file in files]
+    script = 'for path in {}; do'.format(' '.join(shlex.quote(path) for path in paths))
+    script += ' if out=$(python3 {} "$path" 2>&1); then echo "OK $path";'.format(
+        os.path.join('/scripts-dir', 'check_opencv_yaml.py'))
+    script += ' else echo "FAIL $path $(echo "$out" | tail -n 1)"; fi; done'
+    result_str = run_subprocess_str(get_interactive_start_cmd(ctx, script))
+
+    report = dict((file, 'No result') for file in files)
+    for line in result_str.split('\n'):
+        line = line.strip()
+        for file, path in zip(files, paths):
+            if line == 'OK {}'.format(path):
+                report[file] = ''
+            elif line == 'FAIL {}'.format(path) or line.startswith('FAIL {} '.format(path)):
+                report[file] = line[len('FAIL {}'.format(path)):].strip() or 'Failed'
+    return report
+
+def test_all_yaml(ctx):
     """
     test_all_opencv_yaml
     """
-    script_dir = os.path.dirname(os.path.abspath(__file__))
-    interactive_start_path = os.path.join(script_dir, 'interactive_start.sh')
-
     files = [
         os.path.join('config', 'drivarea', 'bisenet_0.yaml'),
         os.path.join('config', 'logger-config.yaml.main'),
@@ -309,27 +1605,24 @@ def test_all_yaml():
         os.path.join('config', 'navigator', 'online_mode.yaml.main'),
         os.path.join('config', 'navigator', 'online_mode.yaml.test'),
         os.path.join('config', 'npme', 'agrodroid.yml.main'),
-        os.path.join('config', 'npme', 'agrodroid.yml.main'),
         os.path.join('config', 'npme', 'npme.yml.main'),
         os.path.join('config', 'npme', 'npme.yml.test'),
         os.path.join('data', 'online_calib', 'sense_poses.yml')
     ]
-    for file in files:
-        path = os.path.join('/external-dir', file)
-        cgn.utils.run_subprocess(
-            '{} python3 {} {}'.format(
-                interactive_start_path,
-                os.path.join('/scripts-dir', 'check_opencv_yaml.py'), path),
-            use_assert=True)
+    status = True
+    for file, error in check_opencv_yaml_files(ctx, files).items():
+        if len(error) > 0:
+            cgn.console.print_warning('{}: {}'.format(file, error))
+            status = False
+        else:
+            print('{}: ok'.format(file))
+    assert status
 
-def test_all_execute_right():
+def test_all_execute_right(ctx):
     """
     Проверка прав выполнения для исполняемых файлов
     """
-    cgn.test.check_execute_right(
-        __file__,
-        relative_path=os.path.join('..', 'containers', 'main', 'bin'),
-        files=['npme', 'npme_healthcheck', 'dbw_checker'])
+    assert_layout(ctx, ['exec'])
 
 def test_all_docker_container():
     """
@@ -346,13 +1639,101 @@ def test_all_docker_images():
         extra_devops_images=['autoheal:latest', 'redis:latest', 'redis-tmp:latest'],
         extra_images=[])
 
-def test_all_sysctl_parameters():
-    """
-    Проверка корректности настройки sysctl-параметров
-    """
-    parameters = ['net.core.wmem_max', 'net.core.wmem_default',
-                  'net.core.rmem_max', 'net.core.rmem_default']
-    cgn.test.check_sysctl_parameters(__file__, parameters, 33554432)
+def read_sysctl_snapshot(root: str = '/proc/sys/net'):
+    """
+    Значения всех доступных для чтения параметров sysctl в root за один обход
+    """
+    snapshot = dict()
+    prefix = os.path.dirname(root.rstrip('/'))
+    for dirpath, _, filenames in os.walk(root):
+        for filename in filenames:
+            path = os.path.join(dirpath, filename)
+            try:
+                with open(path, 'r') as sysctl_file:
+                    value = sysctl_file.read()
+            except OSError:
+                continue
+            key = os.path.relpath(path, prefix).replace('/', '.')
+            snapshot[key] = ' '.join(value.split())
+    return snapshot
+
+def parse_ethtool_output(option: str, text: str):
+    """
+    Разбор вывода ethtool -g (ring), -k (offload) или -c (coalesce): {параметр: значение}
+    """
+    section = {'g': 'ring', 'k': 'offload', 'c': 'coalesce'}[option]
+    settings = dict()
+    current = option != 'g'
+    for line in text.split('\n'):
+        if option == 'g' and line.startswith('Current hardware settings'):
+            current = True
+            continue
+        if option == 'c' and line.startswith('Adaptive'):
+            for name, value in re.findall(r'(RX|TX):\s*(\S+)', line):
+                settings['{}.adaptive-{}'.format(section, name.lower())] = value
+            continue
+        name, sep, value = line.strip().partition(':')
+        if current and sep and value.strip():
+            settings['{}.{}'.format(section, name.strip().lower())] = value.split()[0]
+    return settings
+
+def read_ethtool_settings(interfaces: list):
+    """
+    Настройки интерфейсов (ethtool -g, -k, -c) за один запуск shell
+    """
+    if len(interfaces) == 0:
+        return dict()
+    script = 'for iface in {}; do for opt in g k c; do echo "### $iface $opt";'.format(
+        ' '.join(shlex.quote(interface) for interface in interfaces))
+    script += ' ethtool -$opt "$iface" 2>&1; done; done'
+    sections = re.split(r'^### (\S+) ([gkc])$', run_subprocess_str(script, verbose=False),
+                        flags=re.MULTILINE)
+    settings = dict()
+    for interface, option, text in zip(sections[1::3], sections[2::3], sections[3::3]):
+        for key, value in parse_ethtool_output(option, text).items():
+            settings['ethtool.{}.{}'.format(interface, key)] = value
+    return settings
+
+def get_sysctl_profile(board_model: str):
+    """
+    Объединение профилей SYSCTL_PROFILES, подходящих к модели платы
+    """
+    profile = dict()
+    for key in sorted((key for key in SYSCTL_PROFILES if key in board_model), key=len):
+        profile.update(SYSCTL_PROFILES[key])
+    return profile
+
+def check_profile_value(value: str, expected: str):
+    """
+    Сравнение значения параметра с ожидаемым из профиля
+    """
+    if value is None:
+        return False
+    if expected[:2] in ['>=', '<=']:
+        try:
+            number = int(value.split()[0])
+        except (ValueError, IndexError):
+            return False
+        limit = int(expected[2:])
+        return number >= limit if expected[:2] == '>=' else number <= limit
+    return value == expected
+
+def test_all_sysctl_parameters(ctx):
+    """
+    Проверка настройки ядра и сетевых интерфейсов по профилю SYSCTL_PROFILES
+    """
+    profile = get_sysctl_profile(ctx.board_model)
+    snapshot = read_sysctl_snapshot()
+    interfaces = sorted(set(key.split('.')[1] for key in profile if key.startswith('ethtool.')))
+    snapshot.update(read_ethtool_settings(interfaces))
+    record_metric('snapshot_size', len(snapshot))
+    errors = []
+    for key, expected in sorted(profile.items()):
+        if not check_profile_value(snapshot.get(key), expected):
+            errors.append('{} = {} (expected {})'.format(key, snapshot.get(key), expected))
+    for error in errors:
+        cgn.console.print_error(error)
+    assert len(errors) == 0, '; '.join(errors)
 
 def test_all_groups():
     """
@@ -360,20 +1741,151 @@ def test_all_groups():
     """
     cgn.test.check_groups(['docker', 'flirimaging'])
 
+def drop_file_cache(fd: int):
+    """
+    Сброс страниц файла из page cache, чтобы чтение шло с накопителя
+    """
+    os.fsync(fd)
+    os.posix_fadvise(fd, 0, 0, os.POSIX_FADV_DONTNEED)
+
+def storage_benchmark(directory: str, direct: bool, size: int = STORAGE_BENCH_SIZE):
+    """
+    Замер скорости накопителя на временном файле размером size в directory.
+    direct - O_DIRECT (буферы mmap выровнены по странице), иначе через page cache.
+    Возвращает словарь {параметр: значение}
+    """
+    fd, path = tempfile.mkstemp(prefix='.diagnostics_storage_', dir=directory)
+    os.close(fd)
+    seq_buffer = mmap.mmap(-1, STORAGE_SEQ_BLOCK)
+    seq_buffer.write(os.urandom(STORAGE_SEQ_BLOCK))
+    random_buffer = mmap.mmap(-1, STORAGE_RANDOM_BLOCK)
+    random_buffer.write(os.urandom(STORAGE_RANDOM_BLOCK))
+    count = max(size // STORAGE_SEQ_BLOCK, 1)
+    offsets = [random.randrange(count * STORAGE_SEQ_BLOCK // STORAGE_RANDOM_BLOCK) *
+               STORAGE_RANDOM_BLOCK for _ in range(STORAGE_RANDOM_OPS)]
+    results = dict()
+    try:
+        fd = os.open(path, os.O_RDWR | (os.O_DIRECT if direct else 0))
+        try:
+            start = time.monotonic()
+            for num in range(count):
+                os.pwrite(fd, seq_buffer, num * STORAGE_SEQ_BLOCK)
+            os.fsync(fd)
+            results['seq_write_mbs'] = count / (time.monotonic() - start)
+
+            drop_file_cache(fd)
+            start = time.monotonic()
+            os.lseek(fd, 0, os.SEEK_SET)
+            for num in range(count):
+                os.readv(fd, [seq_buffer])
+            results['seq_read_mbs'] = count / (time.monotonic() - start)
+
+            drop_file_cache(fd)
+            start = time.monotonic()
+            for offset in offsets:
+                os.lseek(fd, offset, os.SEEK_SET)
+                os.readv(fd, [random_buffer])
+            results['rand_read_iops'] = len(offsets) / (time.monotonic() - start)
+
+            start = time.monotonic()
+            for offset in offsets:
+                os.pwrite(fd, random_buffer, offset)
+            os.fsync(fd)
+            results['rand_write_iops'] = len(offsets) / (time.monotonic() - start)
+
+            latencies = []
+            for offset in offsets[:STORAGE_FSYNC_OPS]:
+                start = time.monotonic()
+                os.pwrite(fd, random_buffer, offset)
+                os.fsync(fd)
+                latencies.append((time.monotonic() - start) * 1000.0)
+            results['fsync_avg_ms'] = statistics.mean(latencies)
+            results['fsync_p95_ms'] = get_percentile(latencies, 95)
+        finally:
+            os.close(fd)
+    finally:
+        os.remove(path)
+        seq_buffer.close()
+        random_buffer.close()
+    return results
+
+def get_storage_thresholds(board_model: str):
+    """
+    Пороги STORAGE_THRESHOLDS для модели платы (самое длинное совпадение)
+    """
+    key = max((key for key in STORAGE_THRESHOLDS if key in board_model), key=len)
+    return STORAGE_THRESHOLDS[key]
+
+def get_storage_directories(ctx):
+    """
+    Проверяемые директории {название: путь}, по одной на файловую систему
+    """
+    directories = dict()
+    devices = set()
+    for name, path in [('app', ctx.app_dir),
+                       ('data', os.path.join(ctx.minimal_version_dir, 'containers', 'main',
+                                             'data'))]:
+        path = os.path.realpath(path)
+        if not os.path.isdir(path) or os.stat(path).st_dev in devices:
+            continue
+        devices.add(os.stat(path).st_dev)
+        directories[name] = path
+    return directories
+
+def check_storage_results(results: dict, thresholds: dict):
+    """
+    Сравнение результатов с порогами, возвращает список ошибок
+    """
+    errors = []
+    for key, threshold in sorted(thresholds.items()):
+        value = results[key]
+        if (value > threshold) if key.endswith('_ms') else (value < threshold):
+            errors.append('{} = {:.1f} (threshold {:.1f})'.format(key, value, threshold))
+    return errors
+
+def test_all_storage_benchmark(ctx):
+    """
+    Скорость чтения/записи и задержка fsync накопителей с приложением и данными
+    """
+    thresholds = get_storage_thresholds(ctx.board_model)
+    directories = get_storage_directories(ctx)
+    assert len(directories) > 0, 'No directories to check'
+    errors = []
+    for name, directory in sorted(directories.items()):
+        if shutil.disk_usage(directory).free < 4 * STORAGE_BENCH_SIZE:
+            errors.append('{}: not enough free space for benchmark'.format(directory))
+            continue
+        modes = {'buffered': storage_benchmark(directory, False)}
+        try:
+            modes['direct'] = storage_benchmark(directory, True)
+        except OSError as exc:
+            if exc.errno != errno.EINVAL:
+                raise
+            print('{}: O_DIRECT is not supported'.format(directory))
+        for mode, results in sorted(modes.items()):
+            print('{} ({}) {}: {}'.format(name, directory, mode, ', '.join(
+                '{} {:.1f}'.format(key, value) for key, value in sorted(results.items()))))
+            for key, value in results.items():
+                record_metric('{}_{}_{}'.format(name, mode, key), round(value, 2))
+        for error in check_storage_results(modes.get('direct', modes['buffered']), thresholds):
+            errors.append('{} ({}): {}'.format(name, directory, error))
+    for error in errors:
+        cgn.console.print_error(error)
+    assert len(errors) == 0, '; '.join(errors)
+
 def test_all_free_space():
     """
     Проверка свободного пространства
     """
     cgn.test.test_free_space(__file__, 2 * 1048576)
 
-def test_all_flycap():
+def test_all_flycap(ctx):
     """
     Проверка на то, что серийный номер камеры указан в online_mode.yaml
     """
-    if get_major_image_version() < 44:
-        script_dir = os.path.dirname(os.path.abspath(__file__))
+    if ctx.major_image_version < 44:
         path = os.path.join(
-            script_dir, '..', 'base', 'containers', 'main',
+            ctx.script_dir, '..', 'base', 'containers', 'main',
             'config', 'navigator', 'online_mode.yaml')
         serial_number_str = cgn.test.get_serial_number_from_online_mode(path)
         assert len(serial_number_str) > 5
@@ -385,25 +1897,38 @@ def test_aarch64_username():
     username = os.environ.get('USER')
     assert username == get_default_username()
 
-def test_aarch64_flycap_bin_dir():
+def test_aarch64_flycap_bin_dir(ctx):
     """
     Проверка наличия директории для flycap
     """
-    if get_major_image_version() < 44:
+    if ctx.major_image_version < 44:
         assert os.path.isdir(get_flycap_bin_dir_aarch64())
 
-def test_aarch64_flycap_ldd():
+def test_aarch64_flycap_ldd(ctx):
     """
     Проверка наличия библиотек для flycap-приложений
     """
-    if get_major_image_version() < 44:
-        cmd = 'ldd {} | grep -c "not found"'.format(
-            os.path.join(get_flycap_bin_dir_aarch64(), 'FlyCap2_arm'))
-        assert cgn.utils.run_subprocess_int(cmd) == 0
+    if ctx.major_image_version < 44:
+        paths = [os.path.join(get_flycap_bin_dir_aarch64(), name)
+                 for name in ['FlyCap2_arm', 'FlyCapture2Test']]
+        missing = get_missing_libraries(paths)
+        print(missing)
+        assert all(len(libraries) == 0 for libraries in missing.values())
 
-        cmd = 'ldd {} | grep -c "not found"'.format(
-            os.path.join(get_flycap_bin_dir_aarch64(), 'FlyCapture2Test'))
-        assert cgn.utils.run_subprocess_int(cmd) == 0
+def get_missing_libraries(paths: list):
+    """
+    Один запуск ldd для всех файлов. Возвращает словарь {файл: список ненайденных библиотек}
+    """
+    result_str = run_subprocess_str(
+        'ldd {}'.format(' '.join(shlex.quote(path) for path in paths)))
+    missing = dict((path, []) for path in paths)
+    current_path = paths[0]
+    for line in result_str.split('\n'):
+        if line.rstrip(':') in missing:
+            current_path = line.rstrip(':')
+        elif 'not found' in line:
+            missing[current_path].append(line.split('=>')[0].strip())
+    return missing
 
 def remove_files_by_mask(path: str):
     """
@@ -417,37 +1942,58 @@ def remove_files_by_mask(path: str):
         except OSError:
             print("Error while deleting file : ", file_path)
 
-def test_all_flycap_test():
+def read_flycap_test(cmd: str, serial_number: str, timeout: float = FLYCAP_TEST_TIMEOUT):
+    """
+    Чтение вывода FlyCapture2Test по мере работы утилиты.
+    Утилита завершается, как только получено разрешение камеры serial_number
+    или обнаружено отсутствие камер.
+    Возвращает ({серийный номер: разрешение}, количество камер или None)
+    """
+    state = {'serial_number': '', 'cameras_count': None}
+    params_dict = dict()
+
+    def on_line(line):
+        if line.startswith('Number of cameras detected:'):
+            print(line)
+            state['cameras_count'] = int(line.split(':')[1])
+            if state['cameras_count'] == 0:
+                return True
+        arr = line.split(' - ')
+        if len(arr) == 2:
+            if arr[0] in ['Resolution', 'Serial number']:
+                print(line)
+                if arr[0] == 'Serial number':
+                    state['serial_number'] = arr[1]
+                elif arr[0] == 'Resolution':
+                    params_dict[state['serial_number']] = arr[1]
+                    if state['serial_number'] == serial_number:
+                        return True
+        return False
+
+    result = run_streaming(cmd, timeout=timeout, on_line=on_line)
+    if state['cameras_count'] is None:
+        for line in result['tail']:
+            print(line)
+    return params_dict, state['cameras_count']
+
+def test_all_flycap_test(ctx):
     """
     Проверка корректности работы камеры с помощью утилиты FlyCapture2Test
     """
-    if get_major_image_version() < 44:
-        cmd = "echo -ne '\\n' | timeout 20s {}".format(
-            os.path.join(get_flycap_bin_dir(), 'FlyCapture2Test'))
-        result_str = cgn.utils.run_subprocess_str(cmd)
-
-        script_dir = os.path.dirname(os.path.abspath(__file__))
-        remove_files_by_mask(os.path.join(script_dir, '..', '*.pgm'))
-
-        current_serial_number = ''
-        params_dict = dict()
-        for line in result_str.split('\n'):
-            print('#', line, '#')
-            if line == 'Number of cameras detected: 0':
-                assert False
-            arr = line.split(' - ')
-            if len(arr) == 2:
-                if arr[0] in ['Resolution', 'Serial number']:
-                    if arr[0] == 'Serial number':
-                        current_serial_number = arr[1]
-                    elif arr[0] == 'Resolution':
-                        params_dict[current_serial_number] = arr[1]
-        print(params_dict)
-
+    if ctx.major_image_version < 44:
+        script_dir = ctx.script_dir
         path = os.path.join(
             script_dir, '..', 'base', 'containers', 'main',
             'config', 'navigator', 'online_mode.yaml')
         serial_number = cgn.test.get_serial_number_from_online_mode(path)
+
+        cmd = "echo -ne '\\n' | {}".format(
+            os.path.join(get_flycap_bin_dir(), 'FlyCapture2Test'))
+        params_dict, cameras_count = read_flycap_test(cmd, serial_number)
+        remove_files_by_mask(os.path.join(script_dir, '..', '*.pgm'))
+        print(params_dict)
+
+        assert cameras_count != 0, 'Number of cameras detected: 0'
         assert len(params_dict) > 0
         assert serial_number in params_dict
         assert params_dict[serial_number] == '960x600'
@@ -455,11 +2001,120 @@ def test_all_flycap_test():
         #stderr = result.stderr.decode('UTF-8').strip('\n')
         #assert len(stderr) == 0
 
+def sample_pycapture2_camera(index: int, duration: float):
+    """
+    Времена получения кадров камеры с номером index на шине за duration секунд
+    """
+    bus = PyCapture2.BusManager()
+    camera = PyCapture2.Camera()
+    camera.connect(bus.getCameraFromIndex(index))
+    timestamps = []
+    try:
+        camera.startCapture()
+        deadline = time.monotonic() + duration
+        try:
+            while time.monotonic() < deadline:
+                camera.retrieveBuffer()
+                timestamps.append(time.monotonic())
+        finally:
+            camera.stopCapture()
+    finally:
+        camera.disconnect()
+    return timestamps
+
+def get_camera_samplers(duration: float):
+    """
+    Источники кадров {серийный номер: функция, возвращающая времена кадров}:
+    CAMERA_FRAME_SOURCE или все камеры на шине (PyCapture2)
+    """
+    source = os.environ.get('CAMERA_FRAME_SOURCE', '')
+    if source.startswith('simulate:'):
+        samplers = dict()
+        for item in source[len('simulate:'):].split(','):
+            serial_number, fps = item.split('=')
+            count = int(float(fps) * duration)
+            samplers[serial_number] = lambda fps=float(fps), count=count: [
+                num / fps for num in range(count)]
+        return samplers
+    if source:
+        recorded = load_json_file(source)
+        assert recorded is not None, 'Can not read {}'.format(source)
+        return dict((str(serial_number), lambda timestamps=timestamps: [
+            stamp for stamp in timestamps if stamp - timestamps[0] <= duration])
+                    for serial_number, timestamps in recorded.items() if timestamps)
+    if importlib.util.find_spec('PyCapture2') is None:
+        return dict()
+    bus = PyCapture2.BusManager()
+    return dict((str(bus.getCameraSerialNumberFromIndex(index)),
+                 lambda index=index: sample_pycapture2_camera(index, duration))
+                for index in range(bus.getNumOfCameras()))
+
+def get_frame_stats(timestamps: list):
+    """
+    FPS, пропущенные кадры (интервал больше 1.5 медианного) и разброс интервалов между
+    кадрами без учета пропусков
+    """
+    intervals = [second - first for first, second in zip(timestamps, timestamps[1:])]
+    if len(intervals) == 0 or max(intervals) <= 0:
+        return {'frames': len(timestamps), 'fps': 0.0, 'dropped': 0,
+                'dropped_percent': 100.0, 'jitter_ms': 0.0}
+    median = statistics.median(intervals)
+    dropped = sum(max(round(interval / median) - 1, 0) for interval in intervals
+                  if interval > 1.5 * median)
+    return {
+        'frames': len(timestamps),
+        'fps': len(intervals) / (timestamps[-1] - timestamps[0]),
+        'dropped': dropped,
+        'dropped_percent': 100.0 * dropped / (len(timestamps) + dropped),
+        'jitter_ms': statistics.pstdev(
+            [interval for interval in intervals if interval <= 1.5 * median]) * 1000.0}
+
+def probe_cameras(duration: float = CAMERA_SAMPLE_TIME):
+    """
+    Одновременный сбор кадров со всех камер. Возвращает {серийный номер: статистика}
+    """
+    samplers = get_camera_samplers(duration)
+    if len(samplers) == 0:
+        return dict()
+    with concurrent.futures.ThreadPoolExecutor(max_workers=len(samplers)) as executor:
+        futures = dict((serial_number, executor.submit(sampler))
+                       for serial_number, sampler in samplers.items())
+        return dict((serial_number, get_frame_stats(future.result()))
+                    for serial_number, future in futures.items())
+
+def test_all_camera_fps():
+    """
+    Частота кадров, пропуски и разброс интервалов между кадрами для всех камер
+    """
+    results = probe_cameras()
+    if len(results) == 0:
+        print('No cameras: PyCapture2 is not available and CAMERA_FRAME_SOURCE is not set')
+        return
+    errors = []
+    for serial_number, stats in sorted(results.items()):
+        print('{}: {} frames, {:.1f} fps, dropped {} ({:.1f}%), jitter {:.2f} ms'.format(
+            serial_number, stats['frames'], stats['fps'], stats['dropped'],
+            stats['dropped_percent'], stats['jitter_ms']))
+        for key in ['fps', 'dropped_percent', 'jitter_ms']:
+            record_metric('{}_{}'.format(serial_number, key), round(stats[key], 2))
+        if stats['fps'] < CAMERA_MIN_FPS:
+            errors.append('{}: fps {:.1f} < {}'.format(
+                serial_number, stats['fps'], CAMERA_MIN_FPS))
+        if stats['dropped_percent'] > CAMERA_MAX_DROPPED_PERCENT:
+            errors.append('{}: dropped {:.1f}% > {}%'.format(
+                serial_number, stats['dropped_percent'], CAMERA_MAX_DROPPED_PERCENT))
+        if stats['jitter_ms'] > CAMERA_MAX_JITTER_MS:
+            errors.append('{}: jitter {:.2f} ms > {} ms'.format(
+                serial_number, stats['jitter_ms'], CAMERA_MAX_JITTER_MS))
+    for error in errors:
+        cgn.console.print_error(error)
+    assert len(errors) == 0, '; '.join(errors)
+
 def test_aarch64_ip_for_main_connection():
     """
     Проверка текущего IP-адреса
     """
-    assert cgn.utils.run_subprocess_int('ifconfig | grep -c "192.168."') > 0
+    assert run_subprocess_int('ifconfig | grep -c "192.168."') > 0
 
 def check_base_conditions():
     """
@@ -467,8 +2122,8 @@ def check_base_conditions():
     """
     packages = ['expect']
     pip_packages = ['cgn', 'pytest', 'PyYAML']
-    cgn.test.check_deb_packages(packages)
-    cgn.test.check_pip_packages(pip_packages)
+    check_deb_packages(packages)
+    check_pip_packages(pip_packages)
 
 def test_all_interactive_start():
     """
@@ -476,26 +2131,62 @@ def test_all_interactive_start():
     """
     cgn.test.check_interactive_start(__file__)
 
-def test_aarch64_dbw_box():
+def get_percentile(values: list, percent: float):
+    """
+    Перцентиль (метод ближайшего ранга)
+    """
+    if len(values) == 0:
+        return 0.0
+    values = sorted(values)
+    rank = max(math.ceil(percent * len(values) / 100.0), 1)
+    return values[rank - 1]
+
+def dbw_benchmark(ctx, device: str, count: int):
+    """
+    count опросов DBW-блока утилитой dbw_checker в одном запуске контейнера.
+    Время опроса измеряется по моменту появления маркеров начала и конца в выводе
+    """
+    script = 'for num in $(seq 1 {}); do echo "DBW_PROBE_START $num";'.format(count)
+    script += ' ./dbw_checker {}; echo "DBW_PROBE_END $num $?"; done'.format(shlex.quote(device))
+    cmd = get_interactive_start_cmd(ctx, script)
+    print(datetime.datetime.now().strftime("%Y-%m-%d %H:%M:%S"), 'cmd:', cmd)
+
+    latencies = []
+    errors = 0
+    start = None
+    with contextlib.closing(iter_subprocess_lines(cmd, DBW_PROBE_TIMEOUT * (count + 1))) as lines:
+        for line in lines:
+            arr = line.strip().split()
+            if len(arr) == 2 and arr[0] == 'DBW_PROBE_START':
+                start = time.monotonic()
+            elif len(arr) == 3 and arr[0] == 'DBW_PROBE_END' and start is not None:
+                latencies.append((time.monotonic() - start) * 1000.0)
+                if arr[2] != '0':
+                    errors += 1
+                print('{}. exit code: {}, {:.1f} ms'.format(arr[1], arr[2], latencies[-1]))
+            else:
+                print(line)
+    return {
+        'probes': len(latencies), 'errors': errors,
+        'p50_ms': get_percentile(latencies, 50), 'p95_ms': get_percentile(latencies, 95),
+        'max_ms': max(latencies) if latencies else 0.0}
+
+def test_aarch64_dbw_box(ctx):
     """
     test_aarch64_dbw_box
     """
-    script_dir = os.path.dirname(os.path.abspath(__file__))
     device = '/dev/ttyTHS0'
-    model = cgn.utils.run_subprocess_str('cat /proc/device-tree/model', use_assert=True)
-    if 'quill' in model:
+    if 'quill' in ctx.board_model:
         device = '/dev/ttyTHS2'
 
-    cmd = '{} ./{} {}'.format(
-        os.path.join(script_dir, 'interactive_start.sh'),
-        os.path.join('dbw_checker'), device)
-
-    total_cnt = 5
-    for num in range(total_cnt):
-        now = datetime.datetime.now()
-        print(now.strftime("%Y-%m-%d %H:%M:%S"))
-        print('{}. cmd: {}'.format(num, cmd))
-        cgn.utils.run_subprocess(cmd, use_assert=True)
+    stats = dbw_benchmark(ctx, device, DBW_PROBE_COUNT)
+    print(stats)
+    for key, value in stats.items():
+        record_metric('dbw_{}'.format(key), value)
+    assert stats['probes'] == DBW_PROBE_COUNT
+    assert stats['errors'] == 0
+    if DBW_MAX_P95_MS is not None:
+        assert stats['p95_ms'] <= float(DBW_MAX_P95_MS)
 
 def atest_online_stand():
     """
@@ -503,13 +2194,13 @@ def atest_online_stand():
     """
     cmd = 'python3 start_online_stand.py kromka --console --min-fps=5'
     cmd += ' --duration=$ONLINE_STAND_DURATION --serial=auto --use-asserts'
-    cgn.utils.run_subprocess(cmd, use_assert=True)
+    run_subprocess(cmd, use_assert=True)
     if get_major_image_version() < 44:
-        cgn.utils.run_subprocess(
+        run_subprocess(
             'python3 check_flycap_log.py logs_online_kromka.txt --max-diff=0.5',
             use_assert=True)
 
-    script_dir = os.path.dirname(os.path.abspath(__file__))
+    script_dir = get_diagnostics_context().script_dir
     remove_files_by_mask(os.path.join(script_dir, '..', '*.pgm'))
 
 def get_offline_stand_cmd(domain: str):
@@ -521,52 +2212,202 @@ def get_offline_stand_cmd(domain: str):
 
     return cmd
 
-def test_offline_stand_kromka():
+def run_offline_stand(domain: str):
+    """
+    Запуск нейросетевого стенда с разбором FPS и времени обработки кадров из вывода.
+    Если время кадра не выводится, оно оценивается как 1000 / FPS
+    """
+    fps_values = []
+    frame_times = []
+    info = dict()
+    with contextlib.closing(iter_subprocess_lines(
+            get_offline_stand_cmd(domain), OFFLINE_STAND_TIMEOUT, info)) as lines:
+        for line in lines:
+            print(line)
+            match = OFFLINE_STAND_FRAME_TIME_RE.search(line)
+            if match is not None:
+                frame_times.append(float(match.group(1)))
+            match = OFFLINE_STAND_FPS_RE.search(line)
+            if match is not None:
+                fps_values.append(float(match.group(1)))
+    if len(frame_times) == 0:
+        frame_times = [1000.0 / fps for fps in fps_values if fps > 0]
+    return {
+        'status': info['status'],
+        'fps': statistics.mean(fps_values) if fps_values else 0.0,
+        'fps_min': min(fps_values) if fps_values else 0.0,
+        'frame_ms_p50': get_percentile(frame_times, 50),
+        'frame_ms_p95': get_percentile(frame_times, 95),
+        'frame_ms_max': max(frame_times) if frame_times else 0.0,
+        'samples': len(fps_values)}
+
+def get_offline_stand_baseline(ctx, history: list):
+    """
+    Медиана FPS последних результатов для той же версии образа и модели платы
+    """
+    fps_values = [entry['values']['fps'] for entry in history
+                  if entry['version'] == ctx.version and entry['board_model'] == ctx.board_model
+                  and entry['values']['status'] == 'ok' and entry['values']['samples'] > 0]
+    fps_values = fps_values[-OFFLINE_STAND_BASELINE_SIZE:]
+    if len(fps_values) < OFFLINE_STAND_BASELINE_MIN:
+        return None
+    return statistics.median(fps_values)
+
+def check_offline_stand(ctx, domain: str):
+    """
+    Проверка нейросетевого стенда: успешное завершение (включая --min-fps) и отсутствие
+    снижения FPS относительно скользящей базы
+    """
+    stats = run_offline_stand(domain)
+    print(stats)
+    for key, value in stats.items():
+        record_metric('offline_stand_{}'.format(key), value)
+    history = load_json_file(get_cache_path('offline_stand_{}_history.json'.format(domain)), [])
+    baseline = get_offline_stand_baseline(ctx, history)
+    if stats['samples'] > 0:
+        append_history('offline_stand_{}'.format(domain), ctx, stats)
+
+    assert stats['status'] == 'ok', stats['status']
+    if stats['samples'] == 0:
+        # Формат вывода стенда не совпал с шаблоном: без FPS проверка снижения невозможна
+        cgn.console.print_error(
+            'No FPS lines matched {!r} in start_offline_stand.py output, set '
+            'OFFLINE_STAND_FPS_PATTERN'.format(OFFLINE_STAND_FPS_RE.pattern))
+        assert False, 'FPS not found in output'
+    if baseline is not None:
+        record_metric('offline_stand_baseline_fps', baseline)
+        min_fps = baseline * (1.0 - OFFLINE_STAND_MAX_REGRESSION)
+        assert stats['fps'] >= min_fps, 'FPS regression: {:.2f} < {:.2f} (baseline {:.2f})'.format(
+            stats['fps'], min_fps, baseline)
+
+def test_offline_stand_kromka(ctx):
     """
     test_offline_stand_kromka
     """
-    cgn.utils.run_subprocess(get_offline_stand_cmd('kromka'), use_assert=True)
+    check_offline_stand(ctx, 'kromka')
 
-def test_offline_stand_valok():
+def test_offline_stand_valok(ctx):
     """
     test_offline_stand_valok
     """
-    cgn.utils.run_subprocess(get_offline_stand_cmd('valok'), use_assert=True)
+    check_offline_stand(ctx, 'valok')
 
-def test_offline_stand_corn_rows():
+def test_offline_stand_corn_rows(ctx):
     """
     test_offline_stand_corn_rows
     """
-    cgn.utils.run_subprocess(get_offline_stand_cmd('corn_rows'), use_assert=True)
-
-def check_files_owner(directory: str):
-    """
-    check_files_owner
-    """
-    status = True
-    for root, subdirs, files in os.walk(directory):
-        print(root)
-        items = list(subdirs)
-        items.extend(files)
-        for path in items:
-            full_path = os.path.join(root, path)
-            if not os.path.islink(full_path) or (
-                    os.path.islink(full_path) and os.path.exists(os.path.realpath(full_path))):
-                file_stat = os.stat(full_path)
-                if file_stat.st_uid != os.getuid() or file_stat.st_gid != os.getgid():
-                    cgn.console.print_warning('Ownership problem: ', full_path)
-                    status = False
-    assert status
-
-def test_all_files_owner():
+    check_offline_stand(ctx, 'corn_rows')
+
+def get_cache_path(name: str):
+    """
+    Возвращает путь к файлу в директории кэша диагностики
+    """
+    cache_dir = os.path.join(
+        os.environ.get('XDG_CACHE_HOME', os.path.join(os.path.expanduser('~'), '.cache')),
+        'diagnostics')
+    os.makedirs(cache_dir, exist_ok=True)
+    return os.path.join(cache_dir, name)
+
+def load_json_file(path: str, default=None):
+    """
+    Чтение json-файла, при отсутствии или ошибке разбора возвращается default
+    """
+    try:
+        with open(path, 'r') as json_file:
+            return json.load(json_file)
+    except (OSError, ValueError):
+        return default
+
+def save_json_file(path: str, data):
+    """
+    Атомарная запись json-файла
+    """
+    tmp_path = '{}.{}.tmp'.format(path, os.getpid())
+    with open(tmp_path, 'w') as json_file:
+        json.dump(data, json_file)
+    os.replace(tmp_path, path)
+
+def is_subpath(path: str, directory: str):
+    """
+    is_subpath
+    """
+    return path == directory or path.startswith(directory.rstrip(os.sep) + os.sep)
+
+def check_files_owner(directory: str, full: bool = False):
+    """
+    Проверка владельца всех файлов в директории.
+    Файлы директорий, не изменившихся с прошлой проверки (inode, mtime, ctime), не
+    перечитываются - проверяются только их поддиректории. Смена владельца существующего
+    файла в такой директории находится полной проверкой (full=True), которая выполняется
+    также раз в FILES_OWNER_INDEX_TTL секунд
+    """
+    directory = os.path.abspath(directory)
+    index_path = get_cache_path('files_owner_index.json')
+    old_index = load_json_file(index_path, dict())
+    if full or time.time() - old_index.get('created', 0) > FILES_OWNER_INDEX_TTL:
+        old_index = {'created': time.time(), 'dirs': dict()}
+    old_dirs = old_index.get('dirs', dict())
+    dirs = dict((path, value) for path, value in old_dirs.items()
+                if not is_subpath(path, directory))
+
+    uid = os.getuid()
+    gid = os.getgid()
+    problems = []
+    stack = [(directory, os.stat(directory))]
+    while stack:
+        path, dir_stat = stack.pop()
+        key = [dir_stat.st_ino, dir_stat.st_mtime_ns, dir_stat.st_ctime_ns]
+        record = old_dirs.get(path)
+        clean = True
+        if record is not None and record[:3] == key:
+            subdirs = record[3]
+            for name in subdirs:
+                full_path = os.path.join(path, name)
+                try:
+                    entry_stat = os.stat(full_path, follow_symlinks=False)
+                except FileNotFoundError:
+                    continue
+                if entry_stat.st_uid != uid or entry_stat.st_gid != gid:
+                    problems.append(full_path)
+                    clean = False
+                stack.append((full_path, entry_stat))
+        else:
+            subdirs = []
+            try:
+                with os.scandir(path) as entries:
+                    entries = list(entries)
+            except OSError:
+                # Нечитаемая директория (например, root 0700 из контейнера) - проблема,
+                # в индекс не попадает
+                problems.append(path)
+                continue
+            for entry in entries:
+                try:
+                    entry_stat = entry.stat()
+                except FileNotFoundError:
+                    continue
+                if entry_stat.st_uid != uid or entry_stat.st_gid != gid:
+                    problems.append(entry.path)
+                    clean = False
+                if entry.is_dir(follow_symlinks=False):
+                    subdirs.append(entry.name)
+                    stack.append((entry.path, entry_stat))
+        if clean:
+            dirs[path] = key + [subdirs]
+
+    save_json_file(index_path, {'created': old_index['created'], 'dirs': dirs})
+    for path in sorted(set(problems)):
+        cgn.console.print_warning('Ownership problem: ', path)
+    assert len(problems) == 0
+
+def test_all_files_owner(ctx):
     """
     test_all_files_owner
     """
-    app_dir = get_app_dir()
+    app_dir = ctx.app_dir
     app_versions_dir = os.path.join(app_dir, 'versions')
-    script_dir = os.path.dirname(os.path.abspath(__file__))
-    minimal_version_dir = os.path.abspath(os.path.join(script_dir, '..'))
-    minimal_version_dir_parent = os.path.abspath(os.path.join(script_dir, '..', '..'))
+    minimal_version_dir = ctx.minimal_version_dir
+    minimal_version_dir_parent = os.path.dirname(minimal_version_dir)
     check_files_owner(minimal_version_dir)
     if minimal_version_dir_parent == app_versions_dir:
         check_files_owner(app_dir)
@@ -577,16 +2418,15 @@ def get_app_dir():
     """
     return os.path.join('/home', os.environ.get('USER'), 'app')
 
-def test_all_device_id():
+def test_all_device_id(ctx):
     """
     test_all_device_id
     """
-    app_dir = get_app_dir()
+    app_dir = ctx.app_dir
     device_id_path = os.path.join(app_dir, 'ids', 'device_id')
 
     app_versions_dir = os.path.join(app_dir, 'versions')
-    script_dir = os.path.dirname(os.path.abspath(__file__))
-    minimal_version_dir_parent = os.path.abspath(os.path.join(script_dir, '..', '..'))
+    minimal_version_dir_parent = os.path.dirname(ctx.minimal_version_dir)
     if minimal_version_dir_parent == app_versions_dir:
         assert os.path.exists(device_id_path)
         device_id = cgn.utils.read_str_from_file(device_id_path)
@@ -597,65 +2437,81 @@ def test_all_device_id():
             cgn.console.fix_it("cat /etc/hostname |tr -d '\\n' > {}".format(device_id_path))
             assert False
 
-def test_all_dir_cleaner():
+def find_service_container(service: str, image: str):
     """
-    test_all_dir_cleaner
+    Имя запущенного контейнера docker compose сервиса из образа image или пустая строка.
+    Контейнеры предыдущей версии (другой образ) не подходят: в них старые бинарные
+    файлы и конфигурация
     """
-    script_dir = os.path.dirname(os.path.abspath(__file__))
-    yaml_config = app_manager.get_default_config()
-    data = cgn.utils.load_yaml(yaml_config)
+    lines = run_subprocess_str(
+        "docker ps --filter label=com.docker.compose.service={} --filter status=running"
+        " --format '{{{{.Names}}}} {{{{.Image}}}}'".format(service), verbose=False).split('\n')
+    for line in lines:
+        fields = line.split()
+        if len(fields) == 2 and fields[1] == image:
+            return fields[0]
+    return ''
+
+def run_service_dry_run(ctx, service: str, cmd: str, expected: str):
+    """
+    Запуск cmd в контейнере сервиса до появления в выводе expected.
+    Если контейнер сервиса этой версии уже запущен, используется docker exec, иначе
+    создается временный контейнер по отдельной копии конфигурации
+    """
+    container = find_service_container(
+        service, ctx.compose_data['services'][service].get('image', ''))
+    if container:
+        return assert_streaming(
+            'docker exec {} {}'.format(container, cmd), expected=[expected],
+            timeout=SERVICE_DRY_RUN_TIMEOUT)
+
+    data = copy.deepcopy(ctx.compose_data)
     src_keys = list(data['services'].keys())
     for key in src_keys:
-        if key != 'dir_cleaner':
+        if key != service:
             del data['services'][key]
-    cmd = './dir_cleaner --config=/external-dir/configs/dir_cleaner.yml --dry_run'
-    data['services']['dir_cleaner']['entrypoint'] = cmd
-    data['services']['dir_cleaner']['restart'] = 'no'
-    cgn.utils.save_yaml('dir_cleaner_test.yml', data, ' 1.1')
-
-    cmd = '{} --container=dir_cleaner --without-check'.format(
-        os.path.abspath(os.path.join(script_dir, '..', 'autostart.sh')))
-    cmd += ' --without-detached --config=dir_cleaner_test.yml --abort-on-container-exit'
-    cmd += ' --no-color --force-recreate'
-    cgn.utils.run_subprocess('docker ps -a')
-    result_str = cgn.utils.run_subprocess_str(cmd, use_assert=True)
-    assert 'all folders exists, all good' in result_str
-    stop_containers = os.path.abspath(os.path.join(script_dir, '..', 'stop_containers.sh'))
-    cgn.utils.run_subprocess_str(
-        '{} --container=dir_cleaner --config=dir_cleaner_test.yml'.format(stop_containers))
-
-def test_all_dir_monitor():
+    data['services'][service]['entrypoint'] = cmd
+    data['services'][service]['restart'] = 'no'
+    # Копия лежит рядом с исходной конфигурацией, чтобы относительные пути в ней не менялись
+    fd, config_path = tempfile.mkstemp(
+        prefix='.{}_test_'.format(service), suffix='.yml',
+        dir=os.path.dirname(os.path.abspath(ctx.compose_config)))
+    os.close(fd)
+    try:
+        cgn.utils.save_yaml(config_path, data, ' 1.1')
+        cmd = '{} --container={} --without-check'.format(
+            os.path.join(ctx.minimal_version_dir, 'autostart.sh'), service)
+        cmd += ' --without-detached --config={} --abort-on-container-exit'.format(config_path)
+        cmd += ' --no-color --force-recreate'
+        return assert_streaming(cmd, expected=[expected], timeout=SERVICE_DRY_RUN_TIMEOUT)
+    finally:
+        run_subprocess_str('{} --container={} --config={}'.format(
+            os.path.join(ctx.minimal_version_dir, 'stop_containers.sh'), service, config_path))
+        os.remove(config_path)
+
+def test_all_dir_cleaner(ctx):
+    """
+    test_all_dir_cleaner
+    """
+    run_service_dry_run(
+        ctx, 'dir_cleaner',
+        './dir_cleaner --config=/external-dir/configs/dir_cleaner.yml --dry_run',
+        'all folders exists, all good')
+
+def test_all_dir_monitor(ctx):
     """
     test_all_dir_monitor
     """
-    script_dir = os.path.dirname(os.path.abspath(__file__))
-    yaml_config = app_manager.get_default_config()
-    data = cgn.utils.load_yaml(yaml_config)
-    src_keys = list(data['services'].keys())
-    for key in src_keys:
-        if key != 'dir_monitor':
-            del data['services'][key]
-    cmd = './rust_dir_monitor --config=/external-dir/configs/dir_monitor.yml --dry_run'
-    data['services']['dir_monitor']['entrypoint'] = cmd
-    data['services']['dir_monitor']['restart'] = 'no'
-    cgn.utils.save_yaml('dir_monitor_test.yml', data, ' 1.1')
-
-    cmd = '{} --container=dir_monitor --without-check'.format(
-        os.path.abspath(os.path.join(script_dir, '..', 'autostart.sh')))
-    cmd += ' --without-detached --config=dir_monitor_test.yml --abort-on-container-exit'
-    cmd += ' --no-color --force-recreate'
-    cgn.utils.run_subprocess('docker ps -a')
-    result_str = cgn.utils.run_subprocess_str(cmd, use_assert=True)
-    assert 'config is correct' in result_str
-    stop_containers = os.path.abspath(os.path.join(script_dir, '..', 'stop_containers.sh'))
-    cgn.utils.run_subprocess_str(
-        '{} --container=dir_monitor --config=dir_monitor_test.yml'.format(stop_containers))
-
-def test_aarch64_carrier_id():
+    run_service_dry_run(
+        ctx, 'dir_monitor',
+        './rust_dir_monitor --config=/external-dir/configs/dir_monitor.yml --dry_run',
+        'config is correct')
+
+def test_aarch64_carrier_id(ctx):
     """
     test_aarch64_carrier_id
     """
-    app_dir = get_app_dir()
+    app_dir = ctx.app_dir
     carrier_id_path = os.path.join(app_dir, 'ids', 'carrier_id')
     assert os.path.exists(carrier_id_path)
     carrier_id = cgn.utils.read_str_from_file(carrier_id_path)
@@ -663,11 +2519,11 @@ def test_aarch64_carrier_id():
         cgn.console.fix_it('nano {}'.format(carrier_id_path))
         assert False
 
-def test_aarch64_jetson_id():
+def test_aarch64_jetson_id(ctx):
     """
     test_aarch64_jetson_id
     """
-    app_dir = get_app_dir()
+    app_dir = ctx.app_dir
     jetson_id_path = os.path.join(app_dir, 'ids', 'jetson_id')
     assert os.path.exists(jetson_id_path)
     jetson_id = cgn.utils.read_str_from_file(jetson_id_path)
@@ -675,14 +2531,14 @@ def test_aarch64_jetson_id():
         cgn.console.fix_it('nano {}'.format(jetson_id_path))
         assert False
 
-def test_aarch64_crontab():
+def test_aarch64_crontab(ctx):
     """
     test_aarch64_crontab
     """
-    result_str = cgn.utils.run_subprocess_str('crontab -l', use_assert=True)
+    result_str = run_subprocess_str('crontab -l', use_assert=True)
     result_str_arr = result_str.split('\n')
 
-    app_dir = get_app_dir()
+    app_dir = ctx.app_dir
     jetson_id_cmd = 'cat /proc/device-tree/serial-number | tr -cd \'[[:digit:]]\''
     jetson_id_cmd += ' > {}/ids/jetson_id'.format(app_dir)
     carrier_id_cmd = 'python3 {0}/scripts/save_carrier_id.py {0}/ids/carrier_id'.format(
@@ -700,22 +2556,363 @@ def test_aarch64_crontab():
     print('Expected: ', expected_lines)
     assert len(actual_lines) == len(expected_lines)
 
-def test_aarch64_systemd_docker():
+def test_aarch64_systemd_docker(ctx):
     """
     test_aarch64_systemd_docker
     """
-    version_str = get_info_version()
-    if 't71' in version_str:
+    if 't71' in ctx.version:
         docker_service_cfg = '/lib/systemd/system/docker.service'
-        result_int = cgn.utils.run_subprocess_int(
-            'cat {} | grep -c ExecStartPre=/bin/sleep'.format(docker_service_cfg))
-        if result_int != 1:
-            cgn.utils.run_subprocess_int(
-                'cat {} | grep -c ExecStartPre='.format(docker_service_cfg))
+        try:
+            with open(docker_service_cfg, 'r') as cfg_file:
+                lines = [line.strip() for line in cfg_file if 'ExecStartPre=' in line]
+        except OSError:
+            # Нет файла сервиса: как и при отсутствии строки, нужна ручная настройка
+            lines = []
+        if len([line for line in lines if 'ExecStartPre=/bin/sleep' in line]) != 1:
+            print('ExecStartPre lines: ', lines)
             msg = 'Add line "ExecStartPre=/bin/sleep 10" to file {}\n\
 sudo systemctl daemon-reload\nsudo systemctl restart docker'.format(docker_service_cfg)
             cgn.console.fix_it(msg)
             assert False
 
-if __name__ == "__main__":
+def get_test_names(pattern: str = None):
+    """
+    Возвращает имена тестов для текущей архитектуры в порядке объявления
+    """
+    names = []
+    for name, value in list(globals().items()):
+        if not name.startswith('test_') or not callable(value):
+            continue
+        if name.startswith('test_aarch64_') and get_diagnostics_context().arch != 'aarch64':
+            continue
+        if pattern is not None and pattern not in name:
+            continue
+        names.append(name)
+    return names
+
+def read_boot_id():
+    """
+    Идентификатор текущей загрузки системы
+    """
+    return read_str_from_file_safe('/proc/sys/kernel/random/boot_id').strip()
+
+def read_str_from_file_safe(path: str):
+    """
+    Чтение файла, при ошибке возвращается пустая строка
+    """
+    try:
+        with open(path, 'r') as text_file:
+            return text_file.read()
+    except OSError:
+        return ''
+
+def get_mtime(path: str):
+    """
+    Время изменения файла в нс или None, если файл недоступен
+    """
+    try:
+        return os.stat(path).st_mtime_ns
+    except OSError:
+        return None
+
+def get_deb_packages_cache_key(ctx):
+    """
+    get_deb_packages_cache_key
+    """
+    return [get_deb_packages(ctx), get_mtime('/var/lib/dpkg/status')]
+
+def get_docker_images_cache_key(ctx):  # pylint: disable=unused-argument
+    """
+    get_docker_images_cache_key
+    """
+    images = run_subprocess_str(
+        "docker images --no-trunc --format '{{.Repository}}:{{.Tag}} {{.ID}}'", verbose=False)
+    return sorted(images.split())
+
+def get_docker_version_cache_key(ctx):  # pylint: disable=unused-argument
+    """
+    get_docker_version_cache_key
+    """
+    return [get_mtime(shutil.which('docker') or '/usr/bin/docker')]
+
+def get_groups_cache_key(ctx):  # pylint: disable=unused-argument
+    """
+    get_groups_cache_key
+    """
+    return [os.environ.get('USER'), get_mtime('/etc/group')]
+
+def get_crontab_cache_key(ctx):  # pylint: disable=unused-argument
+    """
+    Время изменения crontab пользователя. Если файл недоступен, результат не кэшируется
+    """
+    mtime = get_mtime(os.path.join('/var/spool/cron/crontabs', os.environ.get('USER', '')))
+    return None if mtime is None else [mtime]
+
+# Тесты, успешный результат которых кэшируется: время жизни, с, и функция, возвращающая
+# входные данные теста. Кэш также сбрасывается при смене версии образа и перезагрузке
+CACHED_TESTS = {
+    'test_all_deb_packages': (24 * 3600, get_deb_packages_cache_key),
+    'test_all_docker_images': (3600, get_docker_images_cache_key),
+    'test_all_docker_version': (24 * 3600, get_docker_version_cache_key),
+    'test_all_groups': (24 * 3600, get_groups_cache_key),
+    'test_aarch64_crontab': (24 * 3600, get_crontab_cache_key),
+}
+
+RESULT_CACHE_LOCK = threading.Lock()
+
+def get_cached_result(ctx, name: str):
+    """
+    Возвращает (время сохранения успешного результата или None, ключ кэша или None)
+    """
+    if name not in CACHED_TESTS:
+        return None, None
+    ttl, key_func = CACHED_TESTS[name]
+    try:
+        key = key_func(ctx)
+    except Exception:  # pylint: disable=broad-except
+        key = None
+    if key is None:
+        return None, None
+    key = [ctx.version, read_boot_id(), key]
+    with RESULT_CACHE_LOCK:
+        entry = load_json_file(get_cache_path('results.json'), dict()).get(name)
+    if entry is not None and entry['key'] == key and time.time() - entry['time'] < ttl:
+        return entry['time'], key
+    return None, key
+
+def save_cached_result(name: str, key: list):
+    """
+    Сохранение успешного результата теста в кэш
+    """
+    with RESULT_CACHE_LOCK:
+        path = get_cache_path('results.json')
+        cache = load_json_file(path, dict())
+        cache[name] = {'key': key, 'time': time.time()}
+        save_json_file(path, cache)
+
+def get_cached_reason(cached_time: float):
+    """
+    get_cached_reason
+    """
+    return 'Cached result from {}'.format(
+        datetime.datetime.fromtimestamp(cached_time).strftime('%Y-%m-%d %H:%M:%S'))
+
+def run_test(name: str, use_cache: bool = True):
+    """
+    Запуск одного теста, возвращает словарь с результатом
+    """
+    result = {'name': name, 'status': 'passed', 'reason': ''}
+    start_profile(name)
+    start = time.monotonic()
+    cache_key = None
+    if use_cache:
+        cached_time, cache_key = get_cached_result(get_diagnostics_context(), name)
+        if cached_time is not None:
+            result['status'] = 'skipped'
+            result['reason'] = get_cached_reason(cached_time)
+            result['duration'] = time.monotonic() - start
+            result.update(stop_profile())
+            return result
+    try:
+        call_test(globals()[name])
+    except AssertionError as exc:
+        result['status'] = 'failed'
+        result['reason'] = get_failure_reason(exc)
+    except Exception as exc:  # pylint: disable=broad-except
+        result['status'] = 'error'
+        result['reason'] = get_failure_reason(exc)
+    result['duration'] = time.monotonic() - start
+    result.update(stop_profile())
+    if result['status'] == 'passed' and cache_key is not None:
+        save_cached_result(name, cache_key)
+    return result
+
+def call_test(func):
+    """
+    Вызов тестовой функции с передачей фикстуры ctx, если она запрошена
+    """
+    if 'ctx' in inspect.signature(func).parameters:
+        return func(get_diagnostics_context())
+    return func()
+
+def get_failure_reason(exc: BaseException):
+    """
+    Возвращает текст исключения или строку, на которой сработал assert
+    """
+    reason = str(exc)
+    if len(reason) == 0:
+        frame = traceback.extract_tb(exc.__traceback__)[-1]
+        reason = '{}:{}: {}'.format(os.path.basename(frame.filename), frame.lineno, frame.line)
+    return '{}: {}'.format(type(exc).__name__, reason)
+
+def run_tests(names: list, jobs: int = DEFAULT_JOBS, use_cache: bool = True):
+    """
+    Параллельный запуск тестов с учетом используемых ресурсов (см. TEST_RESOURCES
+    и RESOURCE_CAPACITY)
+    """
+    pending = list(names)
+    used_resources = collections.Counter()
+    running = dict()
+    results = dict()
+    for name in names:
+        reason = get_unschedulable_reason(name)
+        if reason:
+            pending.remove(name)
+            results[name] = make_empty_result(name, 'error', reason)
+            print_result(results[name])
+    with concurrent.futures.ThreadPoolExecutor(max_workers=max(jobs, 1)) as executor:
+        while pending or running:
+            for name in list(pending):
+                if len(running) >= max(jobs, 1):
+                    break
+                resources = TEST_RESOURCES.get(name, [])
+                if any(used_resources[resource] >= RESOURCE_CAPACITY.get(resource, 1)
+                       for resource in resources):
+                    continue
+                pending.remove(name)
+                used_resources.update(resources)
+                running[executor.submit(run_test, name, use_cache)] = name
+            done, _ = concurrent.futures.wait(
+                running, return_when=concurrent.futures.FIRST_COMPLETED)
+            for future in done:
+                name = running.pop(future)
+                used_resources.subtract(TEST_RESOURCES.get(name, []))
+                results[name] = future.result()
+                print_result(results[name])
+    return [results[name] for name in names]
+
+def get_unschedulable_reason(name: str):
+    """
+    Причина, по которой тест нельзя запустить (ресурс с емкостью меньше 1),
+    или пустая строка
+    """
+    for resource in TEST_RESOURCES.get(name, []):
+        if RESOURCE_CAPACITY.get(resource, 1) < 1:
+            return 'Unschedulable: capacity of resource {} is {}'.format(
+                resource, RESOURCE_CAPACITY[resource])
+    return ''
+
+RESOURCE_SEMAPHORES = dict()
+RESOURCE_SEMAPHORES_LOCK = threading.Lock()
+
+def get_resource_semaphore(resource: str):
+    """
+    Семафор ресурса с емкостью из RESOURCE_CAPACITY (для запуска тестов вне run_tests)
+    """
+    with RESOURCE_SEMAPHORES_LOCK:
+        if resource not in RESOURCE_SEMAPHORES:
+            RESOURCE_SEMAPHORES[resource] = threading.BoundedSemaphore(
+                RESOURCE_CAPACITY.get(resource, 1))
+        return RESOURCE_SEMAPHORES[resource]
+
+def print_result(result: dict):
+    """
+    Вывод результата теста
+    """
+    msg = '{} {} ({:.1f} s, subprocesses: {} / {:.1f} s)'.format(
+        result['status'].upper(), result['name'], result['duration'],
+        result['subprocess_count'], result['subprocess_time'])
+    if result['status'] == 'passed':
+        print(msg)
+    elif result['status'] == 'skipped':
+        print('{} {}'.format(msg, result['reason']))
+    else:
+        resources = result.get('resources', dict())
+        if resources:
+            msg += ' [max: {}]'.format(', '.join(
+                '{} {}'.format(key, values['max']) for key, values in sorted(resources.items())))
+        cgn.console.print_error('{} {}'.format(msg, result['reason']))
+
+def startup_benchmark(pattern: str = None):
+    """
+    Замер времени запуска в отдельных процессах интерпретатора.
+    Возвращает {этап: (медиана времени, с, текст ошибки или пустая строка)}.
+    Ненулевой код возврата - ошибка этапа (для pytest --collect-only код 5 - "тесты
+    не выбраны" - не ошибка)
+    """
+    script = os.path.abspath(__file__)
+    module = os.path.splitext(os.path.basename(script))[0]
+    pattern = pattern or STARTUP_BENCHMARK_PATTERN
+    cmds = {
+        'import': [sys.executable, '-c', 'import {}'.format(module)],
+        'collect': [sys.executable, '-m', 'pytest', '--collect-only', '-q',
+                    '-p', 'no:cacheprovider', script, '-k', pattern],
+        'run': [sys.executable, script, '--run', '--no-cache', '-k', pattern]}
+    allowed_codes = {'collect': [0, 5]}
+    results = dict()
+    for stage, cmd in cmds.items():
+        durations = []
+        error = ''
+        for _ in range(STARTUP_BENCHMARK_REPEAT):
+            start = time.monotonic()
+            proc = subprocess.run(
+                cmd, cwd=os.path.dirname(script), stdout=subprocess.PIPE,
+                stderr=subprocess.STDOUT, universal_newlines=True, errors='replace', check=False)
+            durations.append(time.monotonic() - start)
+            if proc.returncode not in allowed_codes.get(stage, [0]):
+                lines = proc.stdout.strip().split('\n')
+                error = 'exit code {}: {}'.format(proc.returncode, lines[-1])
+                break
+        results[stage] = (statistics.median(durations), error)
+    return results
+
+def check_startup_benchmark(pattern: str = None):
+    """
+    Сравнение времени запуска с бюджетом STARTUP_BUDGET
+    """
+    failed = []
+    for stage, (duration, error) in startup_benchmark(pattern).items():
+        over = duration > STARTUP_BUDGET[stage]
+        status = ' FAILED ({})'.format(error) if error else ' OVER BUDGET' if over else ''
+        print('{:<8} {:6.3f} s (budget {:.3f} s){}'.format(
+            stage, duration, STARTUP_BUDGET[stage], status))
+        if over or error:
+            failed.append(stage)
+    return failed
+
+def parse_args():
+    """
+    Разбор аргументов командной строки
+    """
+    parser = argparse.ArgumentParser(description='Запуск диагностических тестов')
+    parser.add_argument(
+        '--run', action='store_true', help='Запустить тесты без pytest')
+    parser.add_argument(
+        '-k', dest='pattern', default=None, help='Запускать только тесты, содержащие подстроку')
+    parser.add_argument(
+        '-j', '--jobs', type=int, default=DEFAULT_JOBS, help='Количество параллельных тестов')
+    parser.add_argument(
+        '--no-cache', action='store_true', help='Не использовать сохраненные результаты тестов')
+    parser.add_argument(
+        '--report', default=None, help='Сохранить json-отчет в файл (\'-\' - в stdout)')
+    parser.add_argument(
+        '--junit', default=None, help='Сохранить отчет в формате JUnit XML')
+    parser.add_argument(
+        '--startup-benchmark', action='store_true',
+        help='Проверить время запуска (импорт, сбор тестов, простая проверка -k)')
+    return parser.parse_args()
+
+def main():
+    """
+    main
+    """
+    args = parse_args()
+    if args.startup_benchmark:
+        sys.exit(1 if check_startup_benchmark(args.pattern) else 0)
     check_base_conditions()
+    if args.run:
+        started = datetime.datetime.now()
+        results = run_tests(get_test_names(args.pattern), args.jobs, not args.no_cache)
+        report = make_report(results, started)
+        if args.report:
+            save_report(args.report, report)
+        if args.junit:
+            save_junit_report(args.junit, report)
+        failed = [result for result in results if result['status'] in ['failed', 'error']]
+        skipped = [result for result in results if result['status'] == 'skipped']
+        print('passed: {}, skipped: {}, failed: {}'.format(
+            len(results) - len(failed) - len(skipped), len(skipped), len(failed)))
+        sys.exit(1 if failed else 0)
+
+if __name__ == "__main__":
+    main()
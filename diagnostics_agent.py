@@ -0,0 +1,260 @@
+#!/usr/bin/env python3
+"""
+Фоновый агент диагностики: периодический запуск тестов и выдача последних
+результатов через unix-сокет или локальный HTTP-порт
+"""
+import argparse
+import concurrent.futures
+import http.server
+import json
+import os
+import signal
+import socketserver
+import threading
+import time
+import diagnostics
+
+# Период запуска тестов по умолчанию, с
+DEFAULT_INTERVAL = 3600
+
+# Периоды запуска отдельных тестов, с
+TEST_INTERVALS = {
+    'test_aarch64_ip_for_main_connection': 30,
+    'test_all_redis_connection': 60,
+    'test_all_vehicle_dict': 300,
+    'test_all_free_space': 300,
+    'test_all_docker_container': 600,
+    'test_all_files_owner': 6 * 3600,
+    'test_aarch64_eth_speed': 6 * 3600,
+    'test_all_storage_benchmark': 24 * 3600,
+    'test_offline_stand_kromka': 24 * 3600,
+    'test_offline_stand_valok': 24 * 3600,
+    'test_offline_stand_corn_rows': 24 * 3600,
+}
+
+# Тесты, мешающие работающему навигатору: захватывают камеры или последовательный порт,
+# пересоздают контейнеры, нагружают GPU, канал связи или накопитель. В режиме агента
+# запускаются только с флагом --intrusive
+INTRUSIVE_TESTS = [
+    'test_all_flycap_test',
+    'test_all_camera_fps',
+    'test_aarch64_dbw_box',
+    'test_all_dir_cleaner',
+    'test_all_dir_monitor',
+    'test_aarch64_eth_speed',
+    'test_all_storage_benchmark',
+    'test_offline_stand_kromka',
+    'test_offline_stand_valok',
+    'test_offline_stand_corn_rows',
+]
+
+DEFAULT_SOCKET = os.path.join(
+    os.environ.get('XDG_RUNTIME_DIR', '/tmp'), 'diagnostics_agent.sock')
+
+class AgentState:
+    """
+    Последние результаты тестов. Ответ сервера формируется при обновлении результата,
+    а не при запросе
+    """
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._results = dict()
+        self._responses = dict()
+        self._update_responses()
+
+    def update(self, result: dict):
+        """
+        Сохранение результата теста
+        """
+        result = dict(result)
+        result['time'] = time.time()
+        with self._lock:
+            self._results[result['name']] = result
+            self._update_responses()
+
+    def _update_responses(self):
+        failed = sorted(name for name, result in self._results.items()
+                        if result['status'] in ['failed', 'error'])
+        health = {'status': 'failed' if failed else 'ok', 'failed': failed,
+                  'tests': len(self._results)}
+        responses = {
+            '/': (200, json.dumps(self._results).encode('utf-8')),
+            '/health': (503 if failed else 200, json.dumps(health).encode('utf-8'))}
+        for name, result in self._results.items():
+            responses['/results/{}'.format(name)] = (200, json.dumps(result).encode('utf-8'))
+        responses['/results'] = responses['/']
+        self._responses = responses
+
+    def get_response(self, path: str):
+        """
+        Готовый ответ (код, тело) для пути запроса
+        """
+        return self._responses.get(path.rstrip('/') or '/', (404, b'{"error": "not found"}'))
+
+def make_handler(state: AgentState):
+    """
+    Обработчик HTTP-запросов к агенту
+    """
+    class Handler(http.server.BaseHTTPRequestHandler):
+        """
+        GET / - все результаты, /results/<test> - один тест, /health - сводка
+        """
+        def do_GET(self):  # pylint: disable=invalid-name
+            """
+            do_GET
+            """
+            code, body = state.get_response(self.path)
+            self.send_response(code)
+            self.send_header('Content-Type', 'application/json')
+            self.send_header('Content-Length', str(len(body)))
+            self.end_headers()
+            self.wfile.write(body)
+
+        def log_message(self, format, *args):  # pylint: disable=redefined-builtin
+            pass
+
+    return Handler
+
+class UnixHTTPServer(socketserver.ThreadingMixIn, socketserver.UnixStreamServer):
+    """
+    HTTP-сервер на unix-сокете
+    """
+    daemon_threads = True
+
+class TCPHTTPServer(socketserver.ThreadingMixIn, http.server.HTTPServer):
+    """
+    HTTP-сервер на TCP-порту (http.server.ThreadingHTTPServer появился только в Python 3.7)
+    """
+    daemon_threads = True
+
+def start_servers(args, state: AgentState):
+    """
+    Запуск серверов в отдельных потоках
+    """
+    servers = []
+    handler = make_handler(state)
+    if args.socket:
+        if os.path.exists(args.socket):
+            os.remove(args.socket)
+        servers.append(UnixHTTPServer(args.socket, handler))
+    if args.port:
+        servers.append(TCPHTTPServer(('127.0.0.1', args.port), handler))
+    for server in servers:
+        threading.Thread(target=server.serve_forever, daemon=True).start()
+    return servers
+
+def run_test_locked(name: str):
+    """
+    Запуск теста после захвата всех его ресурсов (см. diagnostics.TEST_RESOURCES)
+    """
+    reason = diagnostics.get_unschedulable_reason(name)
+    if reason:
+        return diagnostics.make_empty_result(name, 'error', reason)
+    locks = [diagnostics.get_resource_semaphore(resource)
+             for resource in sorted(diagnostics.TEST_RESOURCES.get(name, []))]
+    for lock in locks:
+        lock.acquire()
+    try:
+        return diagnostics.run_test(name, use_cache=False)
+    finally:
+        for lock in reversed(locks):
+            lock.release()
+
+def run_agent(args, state: AgentState, stop_event: threading.Event):
+    """
+    Основной цикл: запуск тестов, у которых истек период
+    """
+    ctx = diagnostics.get_diagnostics_context()
+    version_path = os.path.join(ctx.minimal_version_dir, 'info', 'version.txt')
+    version_mtime = diagnostics.get_mtime(version_path)
+
+    names = diagnostics.get_test_names(args.pattern)
+    if not args.intrusive:
+        skipped = [name for name in names if name in INTRUSIVE_TESTS]
+        if skipped:
+            print('Intrusive tests are not run (use --intrusive): {}'.format(' '.join(skipped)))
+        names = [name for name in names if name not in INTRUSIVE_TESTS]
+    next_run = dict((name, 0.0) for name in names)
+    running = set()
+    lock = threading.Lock()
+
+    def on_done(name, future):
+        result = future.result()
+        state.update(result)
+        diagnostics.print_result(result)
+        with lock:
+            running.discard(name)
+            next_run[name] = time.monotonic() + args.intervals.get(
+                name, TEST_INTERVALS.get(name, args.default_interval))
+
+    with concurrent.futures.ThreadPoolExecutor(max_workers=args.jobs) as executor:
+        while not stop_event.is_set():
+            mtime = diagnostics.get_mtime(version_path)
+            if mtime != version_mtime:
+                version_mtime = mtime
+                ctx.invalidate()
+            now = time.monotonic()
+            with lock:
+                due = [name for name in names if name not in running and next_run[name] <= now]
+                running.update(due)
+            for name in due:
+                future = executor.submit(run_test_locked, name)
+                future.add_done_callback(lambda future, name=name: on_done(name, future))
+            stop_event.wait(1.0)
+    diagnostics.close_redis_pools()
+
+def parse_interval(value: str):
+    """
+    parse_interval
+    """
+    name, seconds = value.split('=', 1)
+    return name, float(seconds)
+
+def parse_args():
+    """
+    Разбор аргументов командной строки
+    """
+    parser = argparse.ArgumentParser(description='Фоновый агент диагностики')
+    parser.add_argument(
+        '--socket', default=DEFAULT_SOCKET, help='Unix-сокет для запросов (пусто - отключить)')
+    parser.add_argument('--port', type=int, default=None, help='Порт HTTP на 127.0.0.1')
+    parser.add_argument(
+        '-k', dest='pattern', default=None, help='Запускать только тесты, содержащие подстроку')
+    parser.add_argument(
+        '-j', '--jobs', type=int, default=diagnostics.DEFAULT_JOBS,
+        help='Количество параллельных тестов')
+    parser.add_argument(
+        '--intrusive', action='store_true',
+        help='Запускать тесты, мешающие работе навигатора (см. INTRUSIVE_TESTS)')
+    parser.add_argument(
+        '--default-interval', type=float, default=DEFAULT_INTERVAL,
+        help='Период запуска тестов по умолчанию, с')
+    parser.add_argument(
+        '--interval', dest='intervals', type=parse_interval, action='append', default=[],
+        help='Период запуска теста: <test_name>=<seconds>')
+    args = parser.parse_args()
+    args.intervals = dict(args.intervals)
+    return args
+
+def main():
+    """
+    main
+    """
+    args = parse_args()
+    diagnostics.check_base_conditions()
+    state = AgentState()
+    stop_event = threading.Event()
+    signal.signal(signal.SIGTERM, lambda signum, frame: stop_event.set())
+    signal.signal(signal.SIGINT, lambda signum, frame: stop_event.set())
+    servers = start_servers(args, state)
+    try:
+        run_agent(args, state, stop_event)
+    finally:
+        for server in servers:
+            server.shutdown()
+            server.server_close()
+        if args.socket and os.path.exists(args.socket):
+            os.remove(args.socket)
+
+if __name__ == "__main__":
+    main()
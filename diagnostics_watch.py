@@ -0,0 +1,203 @@
+#!/usr/bin/env python3
+"""
+Наблюдение за файлами конфигурации (inotify) и перезапуск только тех тестов,
+которые читают измененные файлы
+"""
+import argparse
+import ctypes
+import ctypes.util
+import fnmatch
+import os
+import select
+import struct
+import sys
+import time
+import diagnostics
+
+# Пути (шаблоны fnmatch) и тесты, которые их читают.
+# {version_dir} - корень версии, {app_dir} - директория приложения,
+# {compose_dir} - директория docker-compose конфигурации, {user} - имя пользователя
+WATCH_MAP = [
+    ('{app_dir}/ids/device_id', ['test_all_device_id']),
+    ('/etc/hostname', ['test_all_device_id']),
+    ('{app_dir}/ids/carrier_id', ['test_aarch64_carrier_id']),
+    ('{app_dir}/ids/jetson_id', ['test_aarch64_jetson_id']),
+    ('{version_dir}/base/containers/main/config/npme/*',
+     ['test_all_yaml', 'test_all_culture_model_mapping']),
+    ('{version_dir}/base/containers/main/config/navigator/*',
+     ['test_all_yaml', 'test_all_flycap_test']),
+    ('{version_dir}/base/containers/main/config/drivarea/*', ['test_all_yaml']),
+    ('{version_dir}/base/containers/main/config/logger-config.yaml.*', ['test_all_yaml']),
+    ('{version_dir}/base/containers/main/data/online_calib/*', ['test_all_yaml']),
+    ('{version_dir}/containers/main/models_ext/*', ['test_all_culture_model_mapping']),
+    ('{version_dir}/info/models.sha256', ['test_all_culture_model_mapping']),
+    ('{compose_dir}/*.yml', ['test_all_docker_compose_config', 'test_all_dir_cleaner',
+                             'test_all_dir_monitor']),
+    ('{compose_dir}/.env', ['test_all_docker_compose_config']),
+    ('/var/spool/cron/crontabs/{user}', ['test_aarch64_crontab']),
+    ('/etc/sysctl.conf', ['test_all_sysctl_parameters']),
+    ('/etc/sysctl.d/*', ['test_all_sysctl_parameters']),
+    ('/etc/group', ['test_all_groups']),
+]
+
+# Пауза после последнего изменения перед запуском тестов, с (редакторы пишут файл
+# несколькими операциями)
+DEFAULT_DEBOUNCE = 0.2
+
+IN_ATTRIB = 0x00000004
+IN_CLOSE_WRITE = 0x00000008
+IN_MOVED_FROM = 0x00000040
+IN_MOVED_TO = 0x00000080
+IN_CREATE = 0x00000100
+IN_DELETE = 0x00000200
+IN_Q_OVERFLOW = 0x00004000
+WATCH_MASK = (IN_ATTRIB | IN_CLOSE_WRITE | IN_MOVED_FROM | IN_MOVED_TO | IN_CREATE |
+              IN_DELETE)
+
+INOTIFY_EVENT = struct.Struct('iIII')
+
+class Inotify:
+    """
+    Минимальная обертка над inotify через ctypes
+    """
+    def __init__(self):
+        self._libc = ctypes.CDLL(ctypes.util.find_library('c') or 'libc.so.6', use_errno=True)
+        self.fd = self._libc.inotify_init1(os.O_CLOEXEC)
+        if self.fd < 0:
+            raise OSError(ctypes.get_errno(), 'inotify_init1 failed')
+        self.watches = dict()
+
+    def add_watch(self, path: str, mask: int = WATCH_MASK):
+        """
+        Наблюдение за директорией
+        """
+        wd = self._libc.inotify_add_watch(self.fd, os.fsencode(path), mask)
+        if wd < 0:
+            errno = ctypes.get_errno()
+            raise OSError(errno, os.strerror(errno), path)
+        self.watches[wd] = path
+
+    def read_paths(self, timeout: float):
+        """
+        Пути, измененные за время ожидания (None - очередь событий переполнена)
+        """
+        if not select.select([self.fd], [], [], timeout)[0]:
+            return []
+        data = os.read(self.fd, 65536)
+        paths = []
+        offset = 0
+        while offset < len(data):
+            wd, mask, _, length = INOTIFY_EVENT.unpack_from(data, offset)
+            offset += INOTIFY_EVENT.size
+            name = os.fsdecode(data[offset:offset + length].rstrip(b'\0'))
+            offset += length
+            if mask & IN_Q_OVERFLOW:
+                return None
+            if wd in self.watches:
+                paths.append(os.path.join(self.watches[wd], name))
+        return paths
+
+    def close(self):
+        """
+        close
+        """
+        os.close(self.fd)
+
+def get_watch_patterns(ctx):
+    """
+    Шаблоны WATCH_MAP с подставленными путями: [(шаблон, тесты)]
+    """
+    values = {
+        'version_dir': ctx.minimal_version_dir,
+        'app_dir': ctx.app_dir,
+        'compose_dir': os.path.dirname(os.path.abspath(ctx.compose_config)),
+        'user': os.environ.get('USER', '')}
+    return [(os.path.normpath(pattern.format(**values)), tests) for pattern, tests in WATCH_MAP]
+
+def get_affected_tests(patterns: list, paths: list, names: list):
+    """
+    Тесты из names, читающие хотя бы один из измененных файлов (paths=None - все тесты
+    из WATCH_MAP). Скрытые файлы учитываются, только если шаблон явно начинается с точки:
+    временные копии конфигурации (.dir_cleaner_test_*.yml), которые создают сами тесты,
+    не должны вызывать их повторный запуск
+    """
+    if paths is None:
+        return [name for name in names if any(name in tests for _, tests in patterns)]
+    tests = set()
+    for path in paths:
+        hidden = os.path.basename(path).startswith('.')
+        for pattern, pattern_tests in patterns:
+            if hidden and not os.path.basename(pattern).startswith('.'):
+                continue
+            if fnmatch.fnmatch(path, pattern):
+                tests.update(pattern_tests)
+    return [name for name in names if name in tests]
+
+def watch(args):
+    """
+    Основной цикл: ожидание изменений и запуск затронутых тестов
+    """
+    ctx = diagnostics.get_diagnostics_context()
+    patterns = get_watch_patterns(ctx)
+    names = diagnostics.get_test_names(args.pattern)
+    inotify = Inotify()
+    try:
+        for directory in sorted(set(os.path.dirname(pattern) for pattern, _ in patterns)):
+            try:
+                inotify.add_watch(directory)
+            except OSError as exc:
+                print('Not watched: {} ({})'.format(directory, exc.strerror))
+        print('Watching {} directories, Ctrl+C to stop'.format(len(inotify.watches)))
+        while True:
+            changed = inotify.read_paths(None)
+            deadline = time.monotonic() + args.debounce
+            while changed is not None and time.monotonic() < deadline:
+                paths = inotify.read_paths(max(deadline - time.monotonic(), 0))
+                if paths is None:
+                    changed = None
+                elif paths:
+                    changed.extend(paths)
+                    deadline = time.monotonic() + args.debounce
+            if changed is None:
+                print('inotify queue overflow, running all watched tests')
+            tests = get_affected_tests(patterns, changed, names)
+            if len(tests) == 0:
+                continue
+            print('Changed: {}'.format(' '.join(sorted(set(changed or [])))))
+            ctx.invalidate()
+            diagnostics.run_tests(tests, args.jobs, use_cache=False)
+    finally:
+        inotify.close()
+
+def parse_args():
+    """
+    Разбор аргументов командной строки
+    """
+    parser = argparse.ArgumentParser(
+        description='Перезапуск диагностических тестов при изменении файлов')
+    parser.add_argument(
+        '-k', dest='pattern', default=None, help='Запускать только тесты, содержащие подстроку')
+    parser.add_argument(
+        '-j', '--jobs', type=int, default=diagnostics.DEFAULT_JOBS,
+        help='Количество параллельных тестов')
+    parser.add_argument(
+        '--debounce', type=float, default=DEFAULT_DEBOUNCE,
+        help='Пауза после последнего изменения перед запуском тестов, с')
+    return parser.parse_args()
+
+def main():
+    """
+    main
+    """
+    args = parse_args()
+    diagnostics.check_base_conditions()
+    try:
+        watch(args)
+    except KeyboardInterrupt:
+        pass
+    finally:
+        diagnostics.close_redis_pools()
+    sys.exit(0)
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,198 @@
+#!/usr/bin/env python3
+"""
+Запуск диагностических тестов на нескольких устройствах по ssh
+"""
+import argparse
+import asyncio
+import json
+import os
+import shlex
+import sys
+import tempfile
+import time
+
+# Время жизни мастер-подключения ssh после последней сессии, с
+SSH_CONTROL_PERSIST = 60
+
+# Максимальное время одного запуска диагностики на устройстве, с
+DEFAULT_TIMEOUT = 1800
+
+def get_ssh_base_cmd(args, control_dir: str, host: str):
+    """
+    Команда ssh с мультиплексированием подключений к одному устройству
+    """
+    cmd = [args.ssh_command, '-o', 'BatchMode=yes',
+           '-o', 'ControlMaster=auto',
+           '-o', 'ControlPath={}'.format(os.path.join(control_dir, '%C')),
+           '-o', 'ControlPersist={}'.format(SSH_CONTROL_PERSIST),
+           '-o', 'ConnectTimeout={}'.format(args.connect_timeout)]
+    if args.port:
+        cmd.extend(['-p', str(args.port)])
+    for option in args.ssh_option:
+        cmd.extend(['-o', option])
+    cmd.append('{}@{}'.format(args.user, host) if args.user else host)
+    return cmd
+
+def get_remote_cmd(args, pattern: str):
+    """
+    Команда запуска диагностики на устройстве. В stdout выводится только json-отчет
+    """
+    diagnostics_cmd = 'python3 diagnostics.py --run -j {}'.format(args.jobs)
+    if pattern:
+        diagnostics_cmd += ' -k {}'.format(shlex.quote(pattern))
+    report = '/tmp/fleet_diagnostics_$$.json'
+    return 'cd {} && {} --report={} >/dev/null 2>&1; rc=$?; cat {}; rm -f {}; exit $rc'.format(
+        shlex.quote(args.remote_dir), diagnostics_cmd, report, report, report)
+
+async def run_ssh(cmd: list, timeout: float):
+    """
+    Запуск ssh, возвращает (код возврата, stdout, stderr)
+    """
+    proc = await asyncio.create_subprocess_exec(
+        *cmd, stdin=asyncio.subprocess.DEVNULL,
+        stdout=asyncio.subprocess.PIPE, stderr=asyncio.subprocess.PIPE)
+    try:
+        stdout, stderr = await asyncio.wait_for(proc.communicate(), timeout)
+    except asyncio.TimeoutError:
+        proc.kill()
+        await proc.wait()
+        return None, '', 'Timeout after {} s'.format(timeout)
+    return proc.returncode, stdout.decode('utf-8', 'replace'), stderr.decode('utf-8', 'replace')
+
+async def run_host(args, control_dir: str, host: str, hosts_semaphore):
+    """
+    Запуск всех выборок тестов (-k) на одном устройстве
+    """
+    result = {'host': host, 'status': 'ok', 'reason': '', 'duration': 0.0, 'tests': []}
+    async with hosts_semaphore:
+        start = time.monotonic()
+        base_cmd = get_ssh_base_cmd(args, control_dir, host)
+        returncode, _, stderr = await run_ssh(base_cmd + ['true'], args.connect_timeout + 5)
+        if returncode != 0:
+            result['status'] = 'unreachable'
+            result['reason'] = stderr.strip().split('\n')[-1]
+        else:
+            host_semaphore = asyncio.Semaphore(args.per_host)
+
+            async def run_pattern(pattern):
+                async with host_semaphore:
+                    return await run_ssh(base_cmd + [get_remote_cmd(args, pattern)], args.timeout)
+
+            outputs = await asyncio.gather(*[run_pattern(pattern) for pattern in args.patterns])
+            for returncode, stdout, stderr in outputs:
+                try:
+                    result['tests'].extend(json.loads(stdout)['tests'])
+                except (ValueError, KeyError):
+                    result['status'] = 'error'
+                    result['reason'] = (stderr.strip() or 'No report, exit code {}'.format(
+                        returncode)).split('\n')[-1]
+            await run_ssh(base_cmd[:1] + ['-O', 'exit'] + base_cmd[1:], args.connect_timeout)
+        result['duration'] = time.monotonic() - start
+    if result['status'] == 'ok' and any(
+            test['status'] in ['failed', 'error'] for test in result['tests']):
+        result['status'] = 'failed'
+    print_host_result(result)
+    return result
+
+async def run_fleet(args):
+    """
+    Параллельный запуск диагностики на всех устройствах
+    """
+    hosts_semaphore = asyncio.Semaphore(args.max_hosts)
+    with tempfile.TemporaryDirectory(prefix='fleet_ssh_') as control_dir:
+        return await asyncio.gather(
+            *[run_host(args, control_dir, host, hosts_semaphore) for host in args.hosts])
+
+def print_host_result(result: dict):
+    """
+    Вывод результата для одного устройства
+    """
+    failed = [test['name'] for test in result['tests'] if test['status'] in ['failed', 'error']]
+    print('{:<24} {:<12} passed: {:<4} failed: {:<4} {:>7.1f} s {}'.format(
+        result['host'], result['status'], len(result['tests']) - len(failed), len(failed),
+        result['duration'], result['reason'] or ' '.join(failed)))
+
+def print_table(results: list):
+    """
+    Сводная таблица: устройства по строкам, тесты по столбцам
+    """
+    names = []
+    for result in results:
+        for test in result['tests']:
+            if test['name'] not in names:
+                names.append(test['name'])
+    marks = {'passed': '.', 'failed': 'F', 'error': 'E', 'skipped': 's'}
+    width = max([len(result['host']) for result in results] + [4])
+    for num, name in enumerate(names):
+        print('{:>{}}  {:>3}: {}'.format('', width, num, name))
+    print('{:<{}}  {}'.format('host', width, ' '.join('{:>3}'.format(num) for num in range(
+        len(names)))))
+    for result in results:
+        statuses = dict((test['name'], test['status']) for test in result['tests'])
+        print('{:<{}}  {}'.format(result['host'], width, ' '.join(
+            '{:>3}'.format(marks.get(statuses.get(name), '-')) for name in names)))
+
+def read_hosts(args):
+    """
+    Список устройств из аргументов и файла (по одному на строку, # - комментарий)
+    """
+    hosts = list(args.hosts)
+    if args.hosts_file:
+        with open(args.hosts_file, 'r') as hosts_file:
+            for line in hosts_file:
+                line = line.split('#')[0].strip()
+                if line:
+                    hosts.append(line)
+    return list(dict.fromkeys(hosts))
+
+def parse_args():
+    """
+    Разбор аргументов командной строки
+    """
+    parser = argparse.ArgumentParser(description='Запуск диагностики на нескольких устройствах')
+    parser.add_argument('hosts', nargs='*', help='Адреса устройств')
+    parser.add_argument('--hosts-file', default=None, help='Файл со списком устройств')
+    parser.add_argument('--user', default='agrodroid', help='Имя пользователя ssh')
+    parser.add_argument('--port', type=int, default=None, help='Порт ssh')
+    parser.add_argument(
+        '--remote-dir', required=True, help='Директория со скриптами диагностики на устройстве')
+    parser.add_argument(
+        '-k', dest='patterns', action='append', default=None,
+        help='Выборка тестов, можно указать несколько раз')
+    parser.add_argument(
+        '-j', '--jobs', type=int, default=4, help='Количество параллельных тестов на устройстве')
+    parser.add_argument(
+        '--max-hosts', type=int, default=32, help='Количество устройств, проверяемых одновременно')
+    parser.add_argument(
+        '--per-host', type=int, default=1, help='Количество одновременных сессий на устройство')
+    parser.add_argument(
+        '--timeout', type=float, default=DEFAULT_TIMEOUT, help='Таймаут запуска на устройстве, с')
+    parser.add_argument(
+        '--connect-timeout', type=int, default=10, help='Таймаут подключения ssh, с')
+    parser.add_argument(
+        '--ssh-command', default='ssh', help='Клиент ssh (например, заглушка для отладки)')
+    parser.add_argument(
+        '--ssh-option', action='append', default=[], help='Дополнительная опция ssh -o')
+    parser.add_argument('--report', default=None, help='Сохранить общий json-отчет в файл')
+    args = parser.parse_args()
+    args.hosts = read_hosts(args)
+    if args.patterns is None:
+        args.patterns = ['']
+    if len(args.hosts) == 0:
+        parser.error('No hosts')
+    return args
+
+def main():
+    """
+    main
+    """
+    args = parse_args()
+    results = asyncio.run(run_fleet(args))
+    print_table(results)
+    if args.report:
+        with open(args.report, 'w') as report_file:
+            json.dump(results, report_file, indent=2)
+    sys.exit(0 if all(result['status'] == 'ok' for result in results) else 1)
+
+if __name__ == "__main__":
+    main()